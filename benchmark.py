@@ -0,0 +1,495 @@
+"""Offline benchmark of MessageDeleter against a local stand-in for the Discord REST API.
+
+The fake API serves channel history, single delete and bulk delete with
+per-route and global rate limit buckets that answer with 429s the way
+Discord does. Each scenario seeds a channel with synthetic messages from
+many authors, runs a deletion job through the bot's own code and reports
+messages deleted per second, API calls per deleted message and the peak
+memory of the bot process. Nothing talks to the real Discord.
+
+    python benchmark.py                      # all standard scenarios
+    python benchmark.py recent-spam --size 0.1
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import contextlib
+import multiprocessing
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+
+import aiohttp
+from aiohttp import web
+
+DISCORD_EPOCH = 1420070400000
+DAY_MS = 24 * 3600 * 1000
+
+GUILD_ID = 700000000000000001
+BOT_USER_ID = 700000000000000002
+CHANNEL_ID = 700000000000000003
+# Author n of a scenario has id AUTHOR_BASE + n, the first `targets` of them are deleted
+AUTHOR_BASE = 800000000000000000
+
+# Rate limits per bucket as (requests, window in seconds). These are roughly
+# what Discord's headers report for bots today, tune them when that changes.
+ROUTE_LIMITS = {
+    'history': (5, 1.0),
+    'delete': (5, 5.0),
+    'bulk_delete': (1, 1.0),
+    'other': (50, 1.0),
+}
+GLOBAL_LIMIT = (50, 1.0)
+
+SCENARIOS = {
+    # Fresh spam, everything fits the bulk delete window
+    'recent-spam': dict(messages=50_000, authors=500, targets=1, target_fraction=0.2, recent_fraction=1.0),
+    # Old history only, every delete goes through the per-message route
+    'old-history': dict(messages=20_000, authors=200, targets=1, target_fraction=0.05, recent_fraction=0.0),
+    # Coordinated raid: 30 accounts in one pass over mixed-age history
+    'raid': dict(messages=100_000, authors=1_000, targets=30, target_fraction=0.1, recent_fraction=0.8),
+    # Same raid with the message index backfilled before the job starts
+    'raid-indexed': dict(messages=100_000, authors=1_000, targets=30, target_fraction=0.1, recent_fraction=0.8,
+                         indexed=True),
+    # A huge channel with few matches, dominated by the history scan
+    'huge-channel': dict(messages=1_000_000, authors=5_000, targets=1, target_fraction=0.002, recent_fraction=0.9),
+}
+
+def snowflake(ms, sequence=0):
+    return ((ms - DISCORD_EPOCH) << 22) | (sequence & 0x3FFFFF)
+
+def iso_timestamp(message_id):
+    ms = (message_id >> 22) + DISCORD_EPOCH
+    return datetime.fromtimestamp(ms / 1000, timezone.utc).isoformat()
+
+def json_response(data, status=200, headers=None):
+    # discord.py only decodes bodies whose content type is exactly application/json
+    return web.Response(body=json.dumps(data).encode(), status=status, headers=headers, content_type='application/json')
+
+class Bucket:
+    """Fixed window rate limit bucket."""
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.remaining = limit
+        self.reset_at = 0.0
+
+    def take(self):
+        """Returns 0 if the request may go ahead, otherwise the seconds to wait."""
+        now = time.monotonic()
+        if now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = now + self.window
+        if self.remaining <= 0:
+            return self.reset_at - now
+        self.remaining -= 1
+        return 0.0
+
+    def headers(self, name):
+        reset_after = max(self.reset_at - time.monotonic(), 0.0)
+        return {
+            'X-RateLimit-Limit': str(self.limit),
+            'X-RateLimit-Remaining': str(self.remaining),
+            'X-RateLimit-Reset': f'{time.time() + reset_after:.3f}',
+            'X-RateLimit-Reset-After': f'{reset_after:.3f}',
+            'X-RateLimit-Bucket': name,
+        }
+
+class FakeChannel:
+    """Synthetic message history, kept in flat arrays so millions of messages stay small."""
+
+    def __init__(self, channel_id, scenario, seed=0):
+        self.id = channel_id
+        rng = random.Random(seed)
+        now_ms = int(time.time() * 1000)
+        history_ms = scenario.get('history_days', 365) * DAY_MS
+        targets = scenario['targets']
+        entries = []
+        for sequence in range(scenario['messages']):
+            if rng.random() < scenario['recent_fraction']:
+                age = rng.randrange(0, 13 * DAY_MS)
+            else:
+                age = rng.randrange(15 * DAY_MS, history_ms)
+            if rng.random() < scenario['target_fraction']:
+                author = rng.randrange(targets)
+            else:
+                author = targets + rng.randrange(scenario['authors'] - targets)
+            entries.append((snowflake(now_ms - age, sequence), author))
+        entries.sort()
+        self.ids = array('q', (message_id for message_id, _ in entries))
+        self.authors = array('l', (author for _, author in entries))
+        self.deleted = bytearray(len(self.ids))
+        self.targets = targets
+        # The channel is older than anything in it
+        self.created_id = snowflake(now_ms - history_ms - DAY_MS)
+
+    def find(self, message_id):
+        index = bisect_left(self.ids, message_id)
+        if index < len(self.ids) and self.ids[index] == message_id and not self.deleted[index]:
+            return index
+        return None
+
+    def page(self, before=None, after=None, limit=50):
+        """Indexes of the messages a history request returns, newest first."""
+        found = []
+        if after is not None and before is None:
+            # Discord returns the oldest messages after the id, still newest first
+            index = bisect_right(self.ids, after)
+            while index < len(self.ids) and len(found) < limit:
+                if not self.deleted[index]:
+                    found.append(index)
+                index += 1
+            return found[::-1]
+
+        index = (bisect_left(self.ids, before) if before is not None else len(self.ids)) - 1
+        while index >= 0 and len(found) < limit:
+            if after is not None and self.ids[index] <= after:
+                break
+            if not self.deleted[index]:
+                found.append(index)
+            index -= 1
+        return found
+
+    def last_message_id(self):
+        for index in range(len(self.ids) - 1, -1, -1):
+            if not self.deleted[index]:
+                return self.ids[index]
+        return None
+
+    def remaining_targets(self):
+        return sum(1 for author, deleted in zip(self.authors, self.deleted) if author < self.targets and not deleted)
+
+class FakeDiscord:
+    """The handful of REST routes MessageDeleter uses, with Discord's rate limit behaviour."""
+
+    def __init__(self, scenario, time_scale):
+        self.channel = FakeChannel(CHANNEL_ID, scenario)
+        self.time_scale = time_scale
+        self.buckets = {}  # (route, channel id) -> Bucket
+        self.global_bucket = Bucket(GLOBAL_LIMIT[0], GLOBAL_LIMIT[1] * time_scale)
+        self.requests = 0
+        self.rate_limited = 0
+        self.deleted = 0
+        self.users = {}
+
+    def app(self):
+        app = web.Application(middlewares=[self.rate_limit])
+        app.router.add_get('/api/v10/users/@me', self.get_me)
+        app.router.add_get('/api/v10/oauth2/applications/@me', self.get_application)
+        app.router.add_get('/api/v10/channels/{channel_id}', self.get_channel)
+        app.router.add_get('/api/v10/channels/{channel_id}/messages', self.get_messages)
+        app.router.add_post('/api/v10/channels/{channel_id}/messages/bulk-delete', self.bulk_delete)
+        app.router.add_delete('/api/v10/channels/{channel_id}/messages/{message_id}', self.delete_message)
+        app.router.add_get('/bench/stats', self.stats)
+        return app
+
+    def route_name(self, request):
+        if request.path.startswith('/bench/'):
+            return None
+        if request.path.endswith('/bulk-delete'):
+            return 'bulk_delete'
+        if request.method == 'DELETE':
+            return 'delete'
+        if request.path.endswith('/messages'):
+            return 'history'
+        return 'other'
+
+    @web.middleware
+    async def rate_limit(self, request, handler):
+        route = self.route_name(request)
+        if route is None:
+            return await handler(request)
+
+        self.requests += 1
+        key = (route, request.match_info.get('channel_id'))
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            limit, window = ROUTE_LIMITS[route]
+            bucket = self.buckets[key] = Bucket(limit, window * self.time_scale)
+
+        retry_after = self.global_bucket.take()
+        is_global = retry_after > 0
+        if not is_global:
+            retry_after = bucket.take()
+        if retry_after > 0:
+            self.rate_limited += 1
+            headers = {'Retry-After': f'{retry_after:.3f}', 'Via': '1.1 google'}
+            if is_global:
+                headers.update({'X-RateLimit-Global': 'true', 'X-RateLimit-Scope': 'global'})
+            else:
+                headers.update(bucket.headers(route))
+                headers['X-RateLimit-Scope'] = 'user'
+            body = {'message': 'You are being rate limited.', 'retry_after': retry_after, 'global': is_global}
+            return json_response(body, status=429, headers=headers)
+
+        response = await handler(request)
+        response.headers.update(bucket.headers(route))
+        return response
+
+    def user(self, author):
+        if author not in self.users:
+            self.users[author] = {
+                'id': str(AUTHOR_BASE + author),
+                'username': f'user{author}',
+                'discriminator': '0',
+                'global_name': None,
+                'avatar': None,
+            }
+        return self.users[author]
+
+    def message(self, index):
+        message_id = self.channel.ids[index]
+        return {
+            'id': str(message_id),
+            'channel_id': str(self.channel.id),
+            'guild_id': str(GUILD_ID),
+            'author': self.user(self.channel.authors[index]),
+            'content': f'message {message_id}',
+            'timestamp': iso_timestamp(message_id),
+            'edited_timestamp': None,
+            'tts': False,
+            'mention_everyone': False,
+            'mentions': [],
+            'mention_roles': [],
+            'attachments': [],
+            'embeds': [],
+            'pinned': False,
+            'type': 0,
+        }
+
+    def unknown(self, what, code):
+        return json_response({'message': f'Unknown {what}', 'code': code}, status=404)
+
+    async def get_me(self, request):
+        return json_response({
+            'id': str(BOT_USER_ID), 'username': 'benchmark', 'discriminator': '0', 'avatar': None, 'bot': True,
+        })
+
+    async def get_application(self, request):
+        return json_response({
+            'id': str(BOT_USER_ID), 'name': 'benchmark', 'description': '', 'icon': None, 'bot_public': False,
+            'bot_require_code_grant': False, 'verify_key': '', 'flags': 0,
+            'owner': {'id': str(BOT_USER_ID + 1), 'username': 'owner', 'discriminator': '0', 'avatar': None},
+        })
+
+    async def get_channel(self, request):
+        if int(request.match_info['channel_id']) != self.channel.id:
+            return self.unknown('Channel', 10003)
+        last_message_id = self.channel.last_message_id()
+        return json_response({
+            'id': str(self.channel.id),
+            'type': 0,
+            'guild_id': str(GUILD_ID),
+            'name': 'benchmark',
+            'position': 0,
+            'permission_overwrites': [],
+            'nsfw': False,
+            'parent_id': None,
+            'last_message_id': str(last_message_id) if last_message_id else None,
+        })
+
+    async def get_messages(self, request):
+        if int(request.match_info['channel_id']) != self.channel.id:
+            return self.unknown('Channel', 10003)
+        query = request.query
+        before = int(query['before']) if 'before' in query else None
+        after = int(query['after']) if 'after' in query else None
+        limit = min(int(query.get('limit', 50)), 100)
+        return json_response([self.message(index) for index in self.channel.page(before, after, limit)])
+
+    async def delete_message(self, request):
+        index = self.channel.find(int(request.match_info['message_id']))
+        if index is None:
+            return self.unknown('Message', 10008)
+        self.channel.deleted[index] = 1
+        self.deleted += 1
+        return web.Response(status=204)
+
+    async def bulk_delete(self, request):
+        message_ids = [int(message_id) for message_id in (await request.json())['messages']]
+        if not 2 <= len(message_ids) <= 100:
+            return json_response({'message': 'Invalid Form Body', 'code': 50035}, status=400)
+        cutoff = snowflake(int(time.time() * 1000) - 14 * DAY_MS)
+        if any(message_id < cutoff for message_id in message_ids):
+            return json_response(
+                {'message': 'You can only bulk delete messages that are under 14 days old.', 'code': 50034},
+                status=400,
+            )
+        # Unknown ids are skipped, like Discord does
+        for message_id in message_ids:
+            index = self.channel.find(message_id)
+            if index is not None:
+                self.channel.deleted[index] = 1
+                self.deleted += 1
+        return web.Response(status=204)
+
+    async def stats(self, request):
+        return json_response({
+            'requests': self.requests,
+            'rate_limited': self.rate_limited,
+            'deleted': self.deleted,
+            'remaining_targets': self.channel.remaining_targets(),
+        })
+
+def run_server(scenario, time_scale, ports):
+    """Seed the fake API and serve it until the process is terminated."""
+    async def serve():
+        runner = web.AppRunner(FakeDiscord(scenario, time_scale).app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        ports.put(runner.addresses[0][1])
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+async def measure(main, scenario, port):
+    import discord
+
+    discord.http.Route.BASE = f'http://127.0.0.1:{port}/api/v10'
+    stats_url = f'http://127.0.0.1:{port}/bench/stats'
+    async with aiohttp.ClientSession() as session:
+        async def stats():
+            async with session.get(stats_url) as response:
+                return await response.json()
+
+        await main.bot.login('benchmark')
+        try:
+            channel = await main.bot.fetch_channel(CHANNEL_ID)
+            if scenario.get('indexed'):
+                async for _ in main.message_index.scan(channel):
+                    pass
+
+            before = await stats()
+            message_filter = main.MessageFilter({AUTHOR_BASE + n: f'user{n}' for n in range(scenario['targets'])})
+            start = time.perf_counter()
+            await main.MessageDeleter().delete_messages(channel, message_filter)
+            elapsed = time.perf_counter() - start
+            after = await stats()
+        finally:
+            await main.bot.close()
+
+    deleted = after['deleted'] - before['deleted']
+    requests = after['requests'] - before['requests']
+    return {
+        'seconds': elapsed,
+        'deleted': deleted,
+        'remaining': after['remaining_targets'],
+        'deleted_per_second': deleted / elapsed if elapsed else 0.0,
+        'calls_per_deleted': requests / deleted if deleted else float('inf'),
+        'rate_limited': after['rate_limited'] - before['rate_limited'],
+    }
+
+def run_client(scenario, port, env, results):
+    """Run the deletion job in a process of its own, so peak memory is the bot's alone."""
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ.update(env)
+        os.environ['DB_PATH'] = os.path.join(directory, 'benchmark.db')
+        logging.getLogger('discord').setLevel(logging.ERROR)
+        with contextlib.redirect_stdout(io.StringIO()):
+            import main
+            result = asyncio.run(measure(main, scenario, port))
+    # ru_maxrss is in kilobytes on Linux
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    results.put(result)
+
+def run_scenario(name, scenario, time_scale, env):
+    context = multiprocessing.get_context('spawn')
+    ports = context.Queue()
+    results = context.Queue()
+    server = context.Process(target=run_server, args=(scenario, time_scale, ports), daemon=True)
+    server.start()
+    try:
+        port = ports.get(timeout=600)
+        client = context.Process(target=run_client, args=(scenario, port, env, results))
+        client.start()
+        client.join()
+        if client.exitcode != 0:
+            raise RuntimeError(f"{name}: benchmark client exited with {client.exitcode}")
+        result = results.get()
+    finally:
+        server.terminate()
+        server.join()
+    result.update(scenario=name, messages=scenario['messages'])
+    return result
+
+def print_results(results):
+    header = f"{'scenario':<14} {'messages':>9} {'deleted':>8} {'left':>5} {'seconds':>8} {'del/s':>8} {'calls/del':>9} {'429s':>5} {'peak MB':>8}"
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        print(f"{result['scenario']:<14} {result['messages']:>9} {result['deleted']:>8} {result['remaining']:>5} "
+              f"{result['seconds']:>8.1f} {result['deleted_per_second']:>8.1f} {result['calls_per_deleted']:>9.3f} "
+              f"{result['rate_limited']:>5} {result['peak_rss_mb']:>8.1f}")
+
+def find_regressions(results, baseline, tolerance):
+    """Scenarios that got slower, chattier or hungrier than the baseline by more than `tolerance`."""
+    previous = {result['scenario']: result for result in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get(result['scenario'])
+        if old is None:
+            continue
+        if result['remaining']:
+            regressions.append(f"{result['scenario']}: {result['remaining']} target messages left behind")
+        if result['deleted_per_second'] < old['deleted_per_second'] * (1 - tolerance):
+            regressions.append(f"{result['scenario']}: {result['deleted_per_second']:.1f} deletes/s, "
+                               f"was {old['deleted_per_second']:.1f}")
+        if result['calls_per_deleted'] > old['calls_per_deleted'] * (1 + tolerance):
+            regressions.append(f"{result['scenario']}: {result['calls_per_deleted']:.3f} calls per delete, "
+                               f"was {old['calls_per_deleted']:.3f}")
+        if result['peak_rss_mb'] > old['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(f"{result['scenario']}: {result['peak_rss_mb']:.1f} MB peak, "
+                               f"was {old['peak_rss_mb']:.1f}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help=f"scenarios to run, out of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument('--size', type=float, default=1.0, help='scale the number of seeded messages')
+    parser.add_argument('--time-scale', type=float, default=0.05,
+                        help='shrink rate limit windows by this factor so runs finish quickly')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='environment for the bot, e.g. SCAN_CONCURRENCY=8')
+    parser.add_argument('--save', metavar='FILE', help='write the results as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='fail if results regressed against a saved run')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed regression when comparing')
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name!r}, choose from {', '.join(SCENARIOS)}")
+
+    env = dict(item.split('=', 1) for item in args.env)
+    results = []
+    for name in args.scenarios or SCENARIOS:
+        scenario = dict(SCENARIOS[name])
+        scenario['messages'] = max(int(scenario['messages'] * args.size), 1)
+        print(f"Running {name} with {scenario['messages']} messages...", file=sys.stderr)
+        results.append(run_scenario(name, scenario, args.time_scale, env))
+
+    print_results(results)
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = find_regressions(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,17 @@
 import os
+import re
+import json
+import sqlite3
+import collections
+import contextlib
+import time
+import typing
+import aiohttp
+from aiohttp import web
 import discord
 from discord.ext import commands
 import asyncio
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
 # Replace 'TOKEN' with your bot's token
 TOKEN = os.getenv('TOKEN')
@@ -12,108 +21,1432 @@ intents = discord.Intents.default()
 intents.messages = True
 intents.message_content = True
 
+# Rate limit headers of every response are fed to the pacer through this trace
+http_trace = aiohttp.TraceConfig()
+
 # Prefix for bot commands
-bot = commands.Bot(command_prefix='!', intents=intents)
+bot = commands.Bot(command_prefix='!', intents=intents, http_trace=http_trace)
+
+# Discord only bulk deletes up to 100 messages at a time, and only messages
+# younger than 14 days. Keep a margin so a batch can't age out while it fills.
+BULK_DELETE_LIMIT = 100
+BULK_DELETE_MAX_AGE = timedelta(days=14) - timedelta(minutes=10)
+
+# Queue size between the history scan and the deletion workers
+DELETE_QUEUE_SIZE = 1000
+# Single deletes in a channel share one bucket of about 5 requests, the pacer keeps
+# the workers within it and discord.py holds one back until a depleted bucket resets
+DELETE_WORKERS = int(os.getenv('DELETE_WORKERS', 5))
+# How long the bulk worker waits for a batch to fill up before sending it anyway
+BULK_LINGER = 2.0
+
+# A channel's history is split into snowflake ranges that are paged concurrently
+SCAN_CONCURRENCY = int(os.getenv('SCAN_CONCURRENCY', 4))
+# Slices aren't split below an hour of history, not worth a request of its own
+MIN_SLICE_SPAN = (3600 * 1000) << 22
+
+# Message content stays out of the logs unless LOG_CONTENT=1
+LOG_CONTENT = os.getenv('LOG_CONTENT') == '1'
+# Serve Prometheus metrics at http://METRICS_HOST:METRICS_PORT/metrics when the port is set
+METRICS_PORT = os.getenv('METRICS_PORT')
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+class Histogram:
+    """Cumulative histogram in the Prometheus sense."""
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+        self.total += value
+        self.count += 1
+
+class Metrics:
+    """Counters and latency histograms of all deletion jobs. Request latencies
+    and 429s are taken from the bot's HTTP session through the trace."""
+
+    COUNTERS = {
+        'scanned': 'Messages read from channel history',
+        'deleted': 'Messages deleted',
+        'failed': 'Messages that could not be deleted',
+        'rate_limited': 'Responses with status 429',
+        'retries': 'Delete requests sent again after a 429',
+    }
+    HISTOGRAMS = {
+        'delete_latency': 'Latency of delete requests in seconds',
+        'page_fetch_latency': 'Latency of history page requests in seconds',
+    }
+    ROUTES = (
+        ('GET', re.compile(r'/channels/\d+/messages$'), 'page_fetch_latency', None),
+        ('POST', re.compile(r'/channels/\d+/messages/bulk-delete$'), 'delete_latency', 'bulk'),
+        ('DELETE', re.compile(r'/channels/\d+/messages/\d+$'), 'delete_latency', 'single'),
+    )
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.histograms = collections.defaultdict(Histogram)  # (name, route) -> Histogram
+        self.rate_limited_deletes = set()  # (method, path) of deletes whose last response was a 429
+
+    def inc(self, name, amount=1):
+        self.counters[name] += amount
+
+    async def on_request_start(self, session, trace_config_ctx, params):
+        trace_config_ctx.start = time.monotonic()
+        # discord.py sends a rate limited request again itself, that's a retry
+        key = (params.method, params.url.path)
+        if key in self.rate_limited_deletes:
+            self.rate_limited_deletes.discard(key)
+            self.inc('retries')
+
+    async def on_request_end(self, session, trace_config_ctx, params):
+        if params.response.status == 429:
+            self.inc('rate_limited')
+        for method, pattern, name, route in self.ROUTES:
+            if params.method == method and pattern.search(params.url.path):
+                self.histograms[(name, route)].observe(time.monotonic() - trace_config_ctx.start)
+                if name == 'delete_latency' and params.response.status == 429:
+                    self.rate_limited_deletes.add((params.method, params.url.path))
+                return
+
+    def render(self, gauges=None):
+        """The metrics in the Prometheus text format."""
+        lines = []
+        for name, help_text in self.COUNTERS.items():
+            lines += [
+                f'# HELP deleter_{name}_total {help_text}',
+                f'# TYPE deleter_{name}_total counter',
+                f'deleter_{name}_total {self.counters[name]}',
+            ]
+        for name, help_text in self.HISTOGRAMS.items():
+            lines += [f'# HELP deleter_{name}_seconds {help_text}', f'# TYPE deleter_{name}_seconds histogram']
+            for (histogram_name, route), histogram in sorted(self.histograms.items(), key=lambda item: str(item[0])):
+                if histogram_name != name:
+                    continue
+                labels = f'route="{route}",' if route else ''
+                for bound, count in zip(histogram.BUCKETS, histogram.counts):
+                    lines.append(f'deleter_{name}_seconds_bucket{{{labels}le="{bound}"}} {count}')
+                lines.append(f'deleter_{name}_seconds_bucket{{{labels}le="+Inf"}} {histogram.count}')
+                lines.append(f'deleter_{name}_seconds_sum{{{labels.rstrip(",")}}} {histogram.total}')
+                lines.append(f'deleter_{name}_seconds_count{{{labels.rstrip(",")}}} {histogram.count}')
+        for name, value in (gauges or {}).items():
+            lines += [f'# TYPE deleter_{name} gauge', f'deleter_{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        return ', '.join(f"{self.counters[name]} {name.replace('_', ' ')}" for name in self.COUNTERS)
+
+metrics = Metrics()
+http_trace.on_request_start.append(metrics.on_request_start)
+http_trace.on_request_end.append(metrics.on_request_end)
+
+def format_duration(seconds):
+    if seconds is None:
+        return 'unknown'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s"
+
+class RateLimitPacer:
+    """Keeps the live state of the history and delete buckets of every channel, as
+    reported by the X-RateLimit-* headers, and makes scanners and workers wait on it.
+
+    Requests still in flight count against their bucket. While nothing is known
+    about a bucket's current window only one request goes out to find out, so
+    concurrent scanners of a channel don't all hit it at once after a reset."""
+
+    ROUTES = (
+        ('GET', re.compile(r'/channels/(\d+)/messages$'), 'history'),
+        ('POST', re.compile(r'/channels/(\d+)/messages/bulk-delete$'), 'bulk'),
+        ('DELETE', re.compile(r'/channels/(\d+)/messages/\d+$'), 'single'),
+    )
+
+    def __init__(self):
+        self.buckets = {}  # (channel_id, route) -> [remaining, reset_at]
+        self.in_flight = collections.Counter()  # (channel_id, route) -> requests being made
+        self.global_reset_at = 0.0
+        self.changed = asyncio.Event()  # Set and replaced whenever a bucket may have room again
+
+    async def on_request_end(self, session, trace_config_ctx, params):
+        for method, pattern, route in self.ROUTES:
+            match = pattern.search(params.url.path)
+            if params.method == method and match:
+                self.update(int(match.group(1)), route, params.response.status, params.response.headers)
+                return
+
+    def update(self, channel_id, route, status, headers):
+        now = time.monotonic()
+        if status == 429:
+            retry_after = float(headers.get('Retry-After') or headers.get('X-RateLimit-Reset-After') or 1)
+            if headers.get('X-RateLimit-Global') == 'true' or headers.get('X-RateLimit-Scope') == 'global':
+                self.global_reset_at = max(self.global_reset_at, now + retry_after)
+            else:
+                self.buckets[(channel_id, route)] = [0, now + retry_after]
+        else:
+            remaining = headers.get('X-RateLimit-Remaining')
+            reset_after = headers.get('X-RateLimit-Reset-After')
+            if remaining is not None and reset_after is not None:
+                self.buckets[(channel_id, route)] = [int(remaining), now + float(reset_after)]
+        self._notify()
+
+    def _notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    @contextlib.asynccontextmanager
+    async def request(self, channel_id, route):
+        """Wait until the bucket has room, and hold a request of it while the block runs."""
+        key = (channel_id, route)
+        while True:
+            now = time.monotonic()
+            delay = self.global_reset_at - now
+            bucket = self.buckets.get(key)
+            if bucket and bucket[1] <= now:
+                # The bucket has reset since we last heard from it
+                del self.buckets[key]
+                bucket = None
+            if bucket is None:
+                full = self.in_flight[key] > 0
+            else:
+                if bucket[0] <= 0:
+                    delay = max(delay, bucket[1] - now)
+                full = bucket[0] <= self.in_flight[key]
+            if delay <= 0 and not full:
+                break
+            # A response or a finished request may make room before the delay is up
+            try:
+                await asyncio.wait_for(self.changed.wait(), delay if delay > 0 else None)
+            except asyncio.TimeoutError:
+                pass
+
+        self.in_flight[key] += 1
+        try:
+            yield
+        finally:
+            self.in_flight[key] -= 1
+            self._notify()
+
+pacer = RateLimitPacer()
+http_trace.on_request_end.append(pacer.on_request_end)
+
+# Jobs are checkpointed here so they survive a restart of the worker.
+# Point DB_PATH at persistent storage when the local disk is ephemeral.
+DB_PATH = os.getenv('DB_PATH', 'deleter.db')
+
+class JobStore:
+    """Keeps deletion jobs and their progress in SQLite.
+
+    A job's cursor is the oldest message its history scan has looked at, and
+    the pending table holds the messages it has matched but not deleted yet,
+    so a resumed job neither re-fetches history nor loses queued messages."""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                guild_id INTEGER NOT NULL,
+                channel_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                cursor INTEGER,
+                scanned INTEGER NOT NULL DEFAULT 0,
+                deleted INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL DEFAULT 'running',
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS pending (
+                job_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                PRIMARY KEY (job_id, message_id)
+            );
+        ''')
+        self._migrate()
+        self.db.commit()
+
+    # Schema changes after the first version, applied in order by user_version
+    MIGRATIONS = (
+        # Guild jobs: one parent job with a child job per channel.
+        # For guild jobs channel_id is the channel the command was issued in.
+        '''
+        ALTER TABLE jobs ADD COLUMN scope TEXT NOT NULL DEFAULT 'channel';
+        ALTER TABLE jobs ADD COLUMN parent_id INTEGER;
+        CREATE INDEX IF NOT EXISTS jobs_parent ON jobs (parent_id);
+        ''',
+        # The full MessageFilter of the job as JSON, user_id keeps the first target
+        '''
+        ALTER TABLE jobs ADD COLUMN filter TEXT;
+        ''',
+        # Per-slice cursors of partitioned history scans. Once a job is sliced
+        # its cursor is the upper bound of the scan, and a finished slice is deleted.
+        '''
+        ALTER TABLE jobs ADD COLUMN sliced INTEGER NOT NULL DEFAULT 0;
+        CREATE TABLE IF NOT EXISTS job_slices (
+            id INTEGER PRIMARY KEY,
+            job_id INTEGER NOT NULL,
+            lo INTEGER NOT NULL,
+            cursor INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS job_slices_job ON job_slices (job_id);
+        ''',
+        # Jobs wait in the scheduler's queue with status 'queued' before they run
+        '''
+        ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 0;
+        ''',
+    )
+
+    def _migrate(self):
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        for number, script in enumerate(self.MIGRATIONS[version:], start=version + 1):
+            self.db.executescript(script)
+            self.db.execute(f'PRAGMA user_version = {number}')
+
+    def create_job(self, channel, message_filter, cursor=None, scope='channel', parent_id=None,
+                   status='running', priority=0):
+        now = datetime.now().isoformat()
+        row = self.db.execute(
+            'INSERT INTO jobs (guild_id, channel_id, user_id, filter, cursor, scope, parent_id, status, priority,'
+            ' created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (channel.guild.id, channel.id, min(message_filter.user_ids), message_filter.to_json(),
+             cursor, scope, parent_id, status, priority, now, now),
+        )
+        self.db.commit()
+        return self.get_job(row.lastrowid)
+
+    def get_job(self, job_id):
+        return self.db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+
+    def unfinished_jobs(self):
+        """Top level jobs that were still running or queued, guild jobs resume their own children."""
+        return self.db.execute(
+            "SELECT * FROM jobs WHERE status IN ('running', 'queued') AND parent_id IS NULL ORDER BY id"
+        ).fetchall()
+
+    def start_job(self, job_id):
+        self.db.execute("UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ?", (datetime.now().isoformat(), job_id))
+        self.db.commit()
+
+    def child_jobs(self, parent_id):
+        return self.db.execute('SELECT * FROM jobs WHERE parent_id = ?', (parent_id,)).fetchall()
+
+    def pending_messages(self, job_id):
+        rows = self.db.execute('SELECT message_id FROM pending WHERE job_id = ? ORDER BY message_id DESC', (job_id,))
+        return [row[0] for row in rows]
+
+    def add_pending(self, job_id, message_id):
+        self.db.execute('INSERT OR IGNORE INTO pending (job_id, message_id) VALUES (?, ?)', (job_id, message_id))
+
+    def remove_pending(self, job_id, message_ids):
+        self.db.executemany('DELETE FROM pending WHERE job_id = ? AND message_id = ?', [(job_id, i) for i in message_ids])
+
+    def plan_slices(self, job_id, cursor, slices):
+        """Store the slices a job's history scan is split into."""
+        for history_slice in slices:
+            self.add_slice(job_id, history_slice)
+        self.db.execute('UPDATE jobs SET sliced = 1, cursor = ? WHERE id = ?', (cursor, job_id))
+        self.db.commit()
+
+    def job_slices(self, job_id):
+        rows = self.db.execute('SELECT * FROM job_slices WHERE job_id = ? ORDER BY cursor DESC', (job_id,))
+        return [HistorySlice(row['lo'], row['cursor'], row['id']) for row in rows]
+
+    def add_slice(self, job_id, history_slice):
+        row = self.db.execute(
+            'INSERT INTO job_slices (job_id, lo, cursor) VALUES (?, ?, ?)',
+            (job_id, history_slice.lo, history_slice.cursor),
+        )
+        history_slice.id = row.lastrowid
+
+    def update_slice(self, history_slice):
+        self.db.execute(
+            'UPDATE job_slices SET lo = ?, cursor = ? WHERE id = ?',
+            (history_slice.lo, history_slice.cursor, history_slice.id),
+        )
+
+    def remove_slice(self, history_slice):
+        self.db.execute('DELETE FROM job_slices WHERE id = ?', (history_slice.id,))
+
+    def checkpoint(self, job_id, cursor, scanned, deleted):
+        self.db.execute(
+            'UPDATE jobs SET cursor = ?, scanned = ?, deleted = ?, updated_at = ? WHERE id = ?',
+            (cursor, scanned, deleted, datetime.now().isoformat(), job_id),
+        )
+        self.db.commit()
+
+    def finish_job(self, job_id, status):
+        self.db.execute('UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?', (status, datetime.now().isoformat(), job_id))
+        self.db.execute('DELETE FROM pending WHERE job_id = ?', (job_id,))
+        self.db.execute('DELETE FROM job_slices WHERE job_id = ?', (job_id,))
+        self.db.commit()
+
+class HistorySlice:
+    """A snowflake range of a channel's history scanned on its own. The scan
+    pages down from `cursor` (exclusive) to `lo` (inclusive)."""
+
+    def __init__(self, lo, cursor, id=None):
+        self.id = id
+        self.lo = lo
+        self.cursor = cursor
+
+job_store = JobStore(DB_PATH)
+
+# How many scanned messages go between two checkpoints (one history page)
+CHECKPOINT_INTERVAL = 100
+
+# Errors a job is interrupted by rather than failed, discord.py re-raises
+# connection errors once it runs out of retries
+TRANSIENT_ERRORS = (aiohttp.ClientError, OSError, asyncio.TimeoutError, discord.errors.DiscordServerError)
+
+class MessageIndex:
+    """Local index of who wrote which message, so deletion jobs can go straight
+    to a user's messages instead of reading the whole channel history.
+
+    Rows are (channel, message id, author), the timestamp is part of the
+    snowflake. Coverage records the id ranges of a channel in which every
+    message is known to be indexed. Ranges are filled in by history scans,
+    and by on_message for everything posted while the bot is connected."""
+
+    def __init__(self, db):
+        self.db = db
+        self.live_since = None  # Snowflake of the moment the current gateway session started
+        self.live = {}  # Channel id -> newest live message, covered from live_since but not written yet
+        self.live_unflushed = 0
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS message_index (
+                channel_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                author_id INTEGER NOT NULL,
+                PRIMARY KEY (channel_id, message_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS message_index_author ON message_index (channel_id, author_id, message_id);
+            CREATE TABLE IF NOT EXISTS index_coverage (
+                channel_id INTEGER NOT NULL,
+                lo INTEGER NOT NULL,
+                hi INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS index_coverage_channel ON index_coverage (channel_id, hi);
+        ''')
+        self.db.commit()
+
+    def add(self, message):
+        self.db.execute(
+            'INSERT OR IGNORE INTO message_index (channel_id, message_id, author_id) VALUES (?, ?, ?)',
+            (message.channel.id, message.id, message.author.id),
+        )
+
+    def add_live(self, message):
+        """Index a message received over the gateway. Its coverage is kept in
+        memory and written a page's worth of messages at a time."""
+        if self.live_since is None or message.guild is None or message.id <= self.live_since:
+            return
+        self.add(message)
+        self.live[message.channel.id] = max(self.live.get(message.channel.id, 0), message.id)
+        self.live_unflushed += 1
+        if self.live_unflushed >= CHECKPOINT_INTERVAL:
+            self.flush_live()
+
+    def flush_live(self):
+        """Write the coverage of the messages received over the gateway since the last flush."""
+        if not self.live:
+            return
+        for channel_id, hi in self.live.items():
+            self._merge_coverage(channel_id, self.live_since, hi)
+        self.db.commit()
+        self.live.clear()
+        self.live_unflushed = 0
+
+    def start_live(self, since):
+        """A new gateway session starts, anything before it may have been missed."""
+        self.flush_live()
+        self.live_since = since
+
+    def remove(self, channel_id, message_ids):
+        self.db.executemany(
+            'DELETE FROM message_index WHERE channel_id = ? AND message_id = ?',
+            [(channel_id, message_id) for message_id in message_ids],
+        )
+        self.db.commit()
+
+    def add_coverage(self, channel_id, lo, hi):
+        """Mark ids lo..hi (inclusive) of the channel as fully indexed, merging overlapping ranges."""
+        self._merge_coverage(channel_id, lo, hi)
+        self.db.commit()
+
+    def _merge_coverage(self, channel_id, lo, hi):
+        rows = self.db.execute(
+            'SELECT rowid, lo, hi FROM index_coverage WHERE channel_id = ? AND lo <= ? AND hi >= ?',
+            (channel_id, hi + 1, lo - 1),
+        ).fetchall()
+        for row in rows:
+            lo = min(lo, row['lo'])
+            hi = max(hi, row['hi'])
+        self.db.executemany('DELETE FROM index_coverage WHERE rowid = ?', [(row['rowid'],) for row in rows])
+        self.db.execute('INSERT INTO index_coverage (channel_id, lo, hi) VALUES (?, ?, ?)', (channel_id, lo, hi))
+
+    def gaps(self, channel_id, top, bottom=0):
+        """Id ranges (lo, hi) within bottom..top that aren't covered yet, newest first."""
+        if top < bottom:
+            return []
+        self.flush_live()
+        rows = self.db.execute(
+            'SELECT lo, hi FROM index_coverage WHERE channel_id = ? AND lo <= ? AND hi >= ? ORDER BY hi DESC',
+            (channel_id, top, bottom),
+        )
+        gaps = []
+        for row in rows:
+            if row['hi'] < top:
+                gaps.append((row['hi'] + 1, top))
+            top = min(top, row['lo'] - 1)
+            if top < bottom:
+                return gaps
+        gaps.append((bottom, top))
+        return gaps
+
+    def messages(self, channel_id, author_ids, before=None, after=None):
+        """Ids of the authors' indexed messages in the channel between the bounds, newest first."""
+        author_ids = list(author_ids)
+        rows = self.db.execute(
+            f'SELECT message_id FROM message_index WHERE channel_id = ? AND author_id IN ({", ".join("?" * len(author_ids))})'
+            ' AND message_id > ? AND message_id < ? ORDER BY message_id DESC',
+            (channel_id, *author_ids, after or 0, before or 2**63 - 1),
+        )
+        return [row[0] for row in rows]
+
+    async def read(self, channel, lo, hi):
+        """Yield the channel's messages with ids in lo..hi, newest first, indexing
+        them and marking the range covered page by page. Every page waits for
+        room in the channel's history bucket, which all slices of it share."""
+        after = discord.Object(id=lo - 1) if lo > 0 else None
+        before = hi + 1
+        while True:
+            async with pacer.request(channel.id, 'history'):
+                page = [message async for message in channel.history(
+                    limit=CHECKPOINT_INTERVAL, before=discord.Object(id=before), after=after, oldest_first=False,
+                )]
+            for message in page:
+                self.add(message)
+                yield message
+            if len(page) < CHECKPOINT_INTERVAL:
+                break
+            before = page[-1].id
+            self.add_coverage(channel.id, before, hi)
+        self.add_coverage(channel.id, lo, hi)
+
+    async def scan(self, channel):
+        """Yield the channel's messages the index doesn't cover yet, newest first, indexing them."""
+        top = discord.utils.time_snowflake(discord.utils.utcnow())
+        for lo, hi in self.gaps(channel.id, top, channel.id):
+            async for message in self.read(channel, lo, hi):
+                yield message
+
+message_index = MessageIndex(job_store.db)
+
+LINK_PATTERN = re.compile(r'https?://\S+', re.IGNORECASE)
+
+class MessageFilter:
+    """Which messages a deletion job deletes: those of any of a set of users,
+    optionally within snowflake bounds and matching content predicates.
+    Everything is checked in a single pass over the history."""
+
+    def __init__(self, users, after=None, before=None, pattern=None, attachments=False, links=False):
+        self.users = dict(users)  # User id -> name, for logging
+        self.user_ids = frozenset(self.users)
+        self.after = after  # Exclusive snowflake bounds
+        self.before = before
+        self.pattern = re.compile(pattern) if pattern else None
+        self.attachments = attachments
+        self.links = links
+
+    @classmethod
+    def from_job(cls, job):
+        if job['filter'] is None:
+            # Jobs stored before filters existed only have a user id
+            return cls({job['user_id']: str(job['user_id'])})
+        data = json.loads(job['filter'])
+        users = {int(user_id): name for user_id, name in data.pop('users').items()}
+        return cls(users, **data)
+
+    def to_json(self):
+        return json.dumps({
+            'users': self.users,
+            'after': self.after,
+            'before': self.before,
+            'pattern': self.pattern.pattern if self.pattern else None,
+            'attachments': self.attachments,
+            'links': self.links,
+        })
+
+    @property
+    def needs_content(self):
+        """Whether messages have to be read to be matched, so the index alone can't answer."""
+        return bool(self.pattern or self.attachments or self.links)
+
+    def matches(self, message):
+        if message.author.id not in self.user_ids:
+            return False
+        if self.after and message.id <= self.after:
+            return False
+        if self.before and message.id >= self.before:
+            return False
+        if self.pattern and not self.pattern.search(message.content):
+            return False
+        if self.attachments and not message.attachments:
+            return False
+        if self.links and not LINK_PATTERN.search(message.content):
+            return False
+        return True
+
+    def __str__(self):
+        return ', '.join(self.users.values())
 
 class MessageDeleter:
     def __init__(self):
         self.deletion_in_progress = False
         self.cancel_requested = False  # Cancellation flag
-        self.last_message_id = None  # Store ID in memory instead of file
+        self.job_id = None
+        self.last_message_id = None  # Upper bound of the history scan, checkpointed in the job store
+        self.deleted_messages = 0
+        self.processed_messages = 0
+        self.failed_messages = 0
+        self.slices = []  # Slices of the history scan that aren't finished
+        self.backlog = 0  # Matched messages waiting in the queues
 
-    async def delete_messages(self, channel, user, start_from_id=None):
+    async def delete_messages(self, channel, message_filter, start_from_id=None, job=None, parent_id=None):
+        """Delete the messages matching the filter in the channel. Passing a stored
+        job resumes it from its checkpoint instead of starting a new one."""
+        # The scheduler makes a deleter per run, a cancel may already have come in
         self.deletion_in_progress = True
-        self.cancel_requested = False  # Reset cancellation flag at start
-        deleted_messages = 0
-        processed_messages = 0
+        if job is None:
+            cursor = min(filter(None, (start_from_id, message_filter.before)), default=None)
+            job = job_store.create_job(channel, message_filter, cursor, parent_id=parent_id)
+        self.job_id = job['id']
+        self.last_message_id = job['cursor']
+        self.deleted_messages = job['deleted']
+        self.processed_messages = job['scanned']
+        self.failed_messages = 0
+        # Progress of this run, for throughput and ETA
+        self.started = time.monotonic()
+        self.deleted_at_start = self.deleted_messages
+        self.scan_span = None
+        status = 'failed'
         start_time = datetime.now()
         # Prepare a prefix that includes guild and channel info
         prefix = f"[{channel.guild.name}/{channel.name}]"
+
+        # The history scan feeds the workers through bounded queues, so paging
+        # never waits on a delete and deletes never wait on paging
+        bulk_queue = asyncio.Queue(maxsize=DELETE_QUEUE_SIZE)
+        single_queue = asyncio.Queue(maxsize=DELETE_QUEUE_SIZE)
+        workers = [asyncio.create_task(self._bulk_worker(channel, bulk_queue, prefix))]
+        workers += [asyncio.create_task(self._single_worker(single_queue, prefix)) for _ in range(DELETE_WORKERS)]
         try:
-            before = discord.Object(id=start_from_id) if start_from_id else None
-            search_start_logged = False
+            await self._scan_history(channel, message_filter, bulk_queue, single_queue, prefix)
+
+            # Tell the workers there is nothing more coming and let them finish
+            await bulk_queue.put(None)
+            for _ in range(DELETE_WORKERS):
+                await single_queue.put(None)
+            await asyncio.gather(*workers)
+            status = 'cancelled' if self.cancel_requested else 'done'
+
+        except asyncio.CancelledError:
+            # The bot is shutting down, leave the job to be resumed on restart
+            status = None
+            raise
+
+        except TRANSIENT_ERRORS as e:
+            # Keep the pending messages and slices, the job resumes on the next on_ready
+            print(f"{prefix} Job {self.job_id} interrupted by {e!r}, it will be resumed.")
+            status = None
+            raise
+
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            self._checkpoint()
+            if status:
+                job_store.finish_job(self.job_id, status)
+            self.deletion_in_progress = False
+            end_time = datetime.now()
+            duration = (end_time - start_time).total_seconds()
+            print(f"{prefix} Deletion process started at {start_time} and ended at {end_time}.")
+            print(f"{prefix} Deleted {self.deleted_messages} messages from {message_filter} in {duration:.2f} seconds"
+                  f" ({self.failed_messages} failed).")
+
+    def scan_remaining(self):
+        return sum(max(history_slice.cursor - history_slice.lo, 0) for history_slice in self.slices)
+
+    def progress(self):
+        """Deletes per second and estimated seconds left of this run."""
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        rate = (self.deleted_messages - self.deleted_at_start) / elapsed
+        if not self.scan_span:
+            return rate, None
+        remaining = self.scan_remaining()
+        scanned = self.scan_span - remaining
+        if not scanned:
+            return rate, None
+        # The scan has to finish and the workers have to catch up with it
+        eta = remaining * elapsed / scanned
+        if self.backlog:
+            eta = max(eta, self.backlog / rate) if rate else None
+        return rate, eta
+
+    def format_progress(self):
+        rate, eta = self.progress()
+        scanned = 100.0
+        if self.scan_span:
+            scanned = 100.0 * (self.scan_span - self.scan_remaining()) / self.scan_span
+        return (f"{self.deleted_messages} deleted, {self.failed_messages} failed, "
+                f"{self.processed_messages} scanned ({scanned:.0f}% of history), "
+                f"{rate:.1f} deletes/s, ETA {format_duration(eta)}")
 
+    def _checkpoint(self):
+        job_store.checkpoint(self.job_id, self.last_message_id, self.processed_messages, self.deleted_messages)
+
+    async def _scan_history(self, channel, message_filter, bulk_queue, single_queue, prefix):
+        """Page through the channel history and queue matching messages for deletion."""
+        # Messages a previous run matched but never got to delete, and the ones
+        # the index already knows about, are queued without reading history
+        known = set(job_store.pending_messages(self.job_id))
+        if not message_filter.needs_content:
+            known.update(message_index.messages(
+                channel.id, message_filter.user_ids, before=self.last_message_id, after=message_filter.after,
+            ))
+        if known:
+            print(f"{prefix} Queueing {len(known)} known messages for job {self.job_id}.")
+        for message_id in sorted(known, reverse=True):
+            if self.cancel_requested:
+                return
+            job_store.add_pending(self.job_id, message_id)
+            await self._enqueue(channel.get_partial_message(message_id), bulk_queue, single_queue)
+        self._checkpoint()
+
+        if job_store.get_job(self.job_id)['sliced']:
+            slices = job_store.job_slices(self.job_id)
+        else:
+            slices = self._plan_slices(channel, message_filter)
+            job_store.plan_slices(self.job_id, self.last_message_id, slices)
+        self.slices = list(slices)
+        self.scan_span = self.scan_remaining()
+        if not slices:
+            return
+
+        # Scanners take slices off the deque until it is empty and nobody is
+        # left scanning who could still split a slice for them
+        remaining = collections.deque(slices)
+        changed = asyncio.Condition()
+        busy = 0
+
+        async def scanner():
+            nonlocal busy
             while True:
-                # Check for cancellation before starting a new batch
+                async with changed:
+                    await changed.wait_for(lambda: remaining or not busy or self.cancel_requested)
+                    if not remaining or self.cancel_requested:
+                        return
+                    history_slice = remaining.popleft()
+                    busy += 1
+                try:
+                    await self._scan_slice(channel, message_filter, history_slice, bulk_queue, single_queue, prefix, split)
+                finally:
+                    async with changed:
+                        busy -= 1
+                        changed.notify_all()
+
+        async def split(history_slice):
+            """Hand the older half of a dense slice to an idle scanner, if there is one."""
+            if remaining or busy >= SCAN_CONCURRENCY or history_slice.cursor - history_slice.lo < 2 * MIN_SLICE_SPAN:
+                return False
+            middle = (history_slice.lo + history_slice.cursor) // 2
+            older = HistorySlice(history_slice.lo, middle)
+            history_slice.lo = middle
+            job_store.add_slice(self.job_id, older)
+            job_store.update_slice(history_slice)
+            self.slices.append(older)
+            async with changed:
+                remaining.append(older)
+                changed.notify_all()
+            return True
+
+        # One failing scanner stops the others, none of them may outlive the job
+        scanners = [asyncio.create_task(scanner()) for _ in range(SCAN_CONCURRENCY)]
+        try:
+            await asyncio.gather(*scanners)
+        finally:
+            for task in scanners:
+                task.cancel()
+            await asyncio.gather(*scanners, return_exceptions=True)
+        if self.cancel_requested:
+            print(f"{prefix} Deletion process cancelled during history scan.")
+
+    def _plan_slices(self, channel, message_filter):
+        """Split the part of the channel's lifetime the job has to read into slices.
+        The job's cursor becomes the upper bound of the whole scan."""
+        now = discord.utils.time_snowflake(discord.utils.utcnow())
+        if not self.last_message_id:
+            self.last_message_id = now + 1
+        top = self.last_message_id - 1
+        # Nothing in a channel is older than the channel itself
+        bottom = max(message_filter.after + 1 if message_filter.after else 0, channel.id)
+        if message_filter.needs_content:
+            ranges = [(bottom, top)] if bottom <= top else []
+        else:
+            # Only the ranges the index hasn't covered are read from history
+            ranges = message_index.gaps(channel.id, top, bottom)
+
+        # Spread the slices over the time the channel actually had messages in
+        newest = min(top, max(channel.last_message_id or now, bottom))
+        span = sum(min(hi, newest) - lo + 1 for lo, hi in ranges if lo <= newest)
+        slices = []
+        for lo, hi in ranges:
+            count = 1
+            if span and lo <= newest:
+                count = max(1, round(SCAN_CONCURRENCY * (min(hi, newest) - lo + 1) / span))
+            step = max((min(hi, newest) - lo + 1) // count, MIN_SLICE_SPAN)
+            bounds = [lo + step * i for i in range(count) if lo + step * i <= hi] + [hi + 1]
+            for slice_lo, slice_cursor in zip(bounds, bounds[1:]):
+                slices.append(HistorySlice(slice_lo, slice_cursor))
+        slices.sort(key=lambda history_slice: history_slice.cursor, reverse=True)
+        return slices
+
+    async def _scan_slice(self, channel, message_filter, history_slice, bulk_queue, single_queue, prefix, split):
+        """Page through one slice, checkpointing its cursor after every page."""
+        while history_slice.cursor > history_slice.lo and not self.cancel_requested:
+            scanned = 0
+            history = message_index.read(channel, history_slice.lo, history_slice.cursor - 1)
+            async for message in history:
                 if self.cancel_requested:
-                    print(f"{prefix} Deletion process cancelled before processing next batch.")
                     break
 
-                last_message = None  # Track the last message processed in this batch
+                self.processed_messages += 1
+                metrics.inc('scanned')
+                scanned += 1
+                if message_filter.matches(message):
+                    job_store.add_pending(self.job_id, message.id)
+                    await self._enqueue(message, bulk_queue, single_queue)
 
-                async for message in channel.history(limit=1000, before=before):
-                    # Check for cancellation mid-batch
-                    if self.cancel_requested:
-                        print(f"{prefix} Deletion process cancelled during batch processing.")
+                if scanned % CHECKPOINT_INTERVAL == 0:
+                    history_slice.cursor = message.id
+                    job_store.update_slice(history_slice)
+                    self._checkpoint()
+                    # A full page means the slice is dense, restart with the newer half if it got split
+                    if await split(history_slice):
                         break
+                if self.processed_messages % 1000 == 0:
+                    print(f"{prefix} Job {self.job_id}: {self.format_progress()}")
+            else:
+                # The slice ran out of messages
+                job_store.remove_slice(history_slice)
+                self.slices.remove(history_slice)
+                self._checkpoint()
+                return
 
-                    last_message = message
-                    processed_messages += 1
-                    if processed_messages % 1000 == 0:
-                        self.last_message_id = message.id
-                        print(f"{prefix} Viewed message ID: {message.id}, Author: {message.author}, Content: {message.content}")
-
-                    if message.author == user:
-                        try:
-                            await message.delete()
-                            deleted_messages += 1
-                            print(f"{prefix} Deleted message ID: {message.id}, Author: {message.author}, Content: {message.content}")
-                            await asyncio.sleep(1)  # Sleep to handle rate limits
-                        except discord.errors.HTTPException as e:
-                            if e.status == 429:
-                                retry_after = e.response.headers.get('Retry-After')
-                                if retry_after:
-                                    retry_after = float(retry_after)
-                                    print(f"{prefix} Rate limited. Retrying after {retry_after} seconds.")
-                                    await asyncio.sleep(retry_after)
-                            else:
-                                print(f"{prefix} HTTPException: {e}")
-                        except discord.errors.Forbidden:
-                            print(f"{prefix} Forbidden: Cannot delete message in {channel.name}")
-                        except discord.errors.NotFound:
-                            print(f"{prefix} NotFound: Message already deleted in {channel.name}")
-                        except discord.errors.DiscordException as e:
-                            print(f"{prefix} DiscordException: {e}")
-                        except Exception as e:
-                            print(f"{prefix} Unexpected exception: {e}")
-
-                # If cancellation was requested during the inner loop, break out
-                if self.cancel_requested:
-                    break
+    async def _enqueue(self, message, bulk_queue, single_queue):
+        self.backlog += 1
+        # Recent messages go to the bulk endpoint, older ones are deleted one by one
+        if message.created_at > discord.utils.utcnow() - BULK_DELETE_MAX_AGE:
+            await bulk_queue.put(message)
+        else:
+            await single_queue.put(message)
+
+    async def _bulk_worker(self, channel, queue, prefix):
+        """Collect queued messages into batches of up to 100 and bulk delete them."""
+        loop = asyncio.get_running_loop()
+        done = False
+        while not done:
+            message = await queue.get()
+            if message is None:
+                break
 
-                # If no messages were retrieved in this batch, exit the loop
-                if last_message is None:
+            batch = [message]
+            deadline = loop.time() + BULK_LINGER
+            while len(batch) < BULK_DELETE_LIMIT:
+                # Give the scan a moment to fill the batch up
+                try:
+                    message = await asyncio.wait_for(queue.get(), deadline - loop.time())
+                except asyncio.TimeoutError:
                     break
+                if message is None:
+                    done = True
+                    break
+                batch.append(message)
+
+            self.backlog -= len(batch)
+            # Keep draining after a cancel so the scan is never blocked on a full queue
+            if self.cancel_requested:
+                continue
+            await self._bulk_delete(channel, batch, prefix)
+
+    async def _single_worker(self, queue, prefix):
+        """Delete queued messages one by one through the per-message endpoint."""
+        while True:
+            message = await queue.get()
+            if message is None:
+                break
+            self.backlog -= 1
+            if self.cancel_requested:
+                continue
+            await self._delete_single(message, prefix)
+
+    async def _bulk_delete(self, channel, messages, prefix):
+        """Delete up to 100 recent messages with a single bulk delete request."""
+        # A batch that sat in the queue may have aged out of the bulk window
+        bulk_cutoff = discord.utils.utcnow() - BULK_DELETE_MAX_AGE
+        recent = [message for message in messages if message.created_at > bulk_cutoff]
+        for message in messages:
+            if self.cancel_requested:
+                return
+            if message.created_at <= bulk_cutoff:
+                await self._delete_single(message, prefix)
+
+        if len(recent) == 1:
+            await self._delete_single(recent[0], prefix)
+            return
+
+        if not recent or self.cancel_requested:
+            return
+        # discord.py retries rate limited requests itself, a 429 here means it gave up
+        try:
+            async with pacer.request(channel.id, 'bulk'):
+                await channel.delete_messages(recent)
+            self._deleted(recent, prefix)
+            return
+        except discord.errors.Forbidden:
+            print(f"{prefix} Forbidden: Cannot bulk delete messages in {channel.name}")
+            self._failed(recent)
+            self._finished(recent)
+            return
+        except discord.errors.HTTPException as e:
+            print(f"{prefix} HTTPException during bulk delete: {e}")
+        except discord.errors.DiscordException as e:
+            print(f"{prefix} DiscordException during bulk delete: {e}")
+        except Exception as e:
+            print(f"{prefix} Unexpected exception during bulk delete: {e}")
 
-                before = last_message  # Continue from the last message processed
+        # The batch was rejected as a whole, fall back to deleting one by one
+        print(f"{prefix} Falling back to single deletes for {len(recent)} messages.")
+        for message in recent:
+            if self.cancel_requested:
+                break
+            await self._delete_single(message, prefix)
+
+    def _deleted(self, messages, prefix):
+        self.deleted_messages += len(messages)
+        metrics.inc('deleted', len(messages))
+        self._finished(messages)
+        if LOG_CONTENT:
+            for message in messages:
+                print(f"{prefix} Deleted message ID: {message.id}, Author: {getattr(message, 'author', None)}, "
+                      f"Content: {getattr(message, 'content', None)}")
+
+    def _failed(self, messages):
+        self.failed_messages += len(messages)
+        metrics.inc('failed', len(messages))
+
+    def _finished(self, messages):
+        """Drop messages that need no further attempts from the job's pending set."""
+        message_ids = [message.id for message in messages]
+        job_store.remove_pending(self.job_id, message_ids)
+        message_index.remove(messages[0].channel.id, message_ids)
+        self._checkpoint()
+
+    async def _delete_single(self, message, prefix):
+        """Delete one message through the per-message endpoint."""
+        channel = message.channel
+        # discord.py retries rate limited requests itself, a 429 here means it gave up
+        try:
+            async with pacer.request(channel.id, 'single'):
+                await message.delete()
+            self._deleted([message], prefix)
+        except discord.errors.Forbidden:
+            print(f"{prefix} Forbidden: Cannot delete message in {channel.name}")
+            self._failed([message])
+            self._finished([message])
+        except discord.errors.NotFound:
+            print(f"{prefix} NotFound: Message already deleted in {channel.name}")
+            self._finished([message])
+        except discord.errors.HTTPException as e:
+            if e.status == 429:
+                print(f"{prefix} Giving up on message ID: {message.id} after repeated rate limits.")
+            else:
+                print(f"{prefix} HTTPException: {e}")
+            self._failed([message])
+        except discord.errors.DiscordException as e:
+            print(f"{prefix} DiscordException: {e}")
+            self._failed([message])
+        except Exception as e:
+            print(f"{prefix} Unexpected exception: {e}")
+            self._failed([message])
+
+# How many channels of a guild job are scanned and deleted from at the same time.
+# Deletes are rate limited per channel, so separate channels proceed in parallel.
+GUILD_CONCURRENCY = int(os.getenv('GUILD_CONCURRENCY', 10))
+
+async def collect_guild_channels(guild, prefix):
+    """List the text channels, active threads and archived threads of the guild we can read."""
+    channels = list(guild.text_channels)
+    channels += await guild.active_threads()
+
+    # Archived threads hang off text and forum channels, private ones need Manage Threads
+    for parent in guild.text_channels + guild.forums:
+        for private in (False, True):
+            if private and not isinstance(parent, discord.TextChannel):
+                continue
+            try:
+                async for thread in parent.archived_threads(limit=None, private=private):
+                    channels.append(thread)
+            except discord.errors.Forbidden:
+                pass
+            except discord.errors.HTTPException as e:
+                print(f"{prefix} HTTPException listing archived threads of {parent.name}: {e}")
+
+    unique = {}
+    for channel in channels:
+        permissions = channel.permissions_for(guild.me)
+        if permissions.read_message_history and permissions.manage_messages:
+            unique[channel.id] = channel
+    return list(unique.values())
+
+class GuildDeleter:
+    """Deletes the messages matching a filter in every channel and thread of a guild,
+    running a MessageDeleter per channel under a global concurrency limit."""
+
+    def __init__(self):
+        self.deletion_in_progress = False
+        self._cancel_requested = False
+        self.deleters = {}  # Channel id -> MessageDeleter currently running there
+        self._deleted = 0  # Totals of the channels that have finished
+        self._processed = 0
+        self._failed = 0
+        self.channels = 0  # Channels and threads the job covers
+        self.finished_channels = 0
+        self.started = time.monotonic()
+        self.deleted_at_start = 0
+
+    @property
+    def cancel_requested(self):
+        return self._cancel_requested
+
+    @cancel_requested.setter
+    def cancel_requested(self, value):
+        # Cancelling the guild job cancels every channel it is running in
+        self._cancel_requested = value
+        for deleter in self.deleters.values():
+            deleter.cancel_requested = value
+
+    @property
+    def deleted_messages(self):
+        return self._deleted + sum(deleter.deleted_messages for deleter in self.deleters.values())
+
+    @property
+    def processed_messages(self):
+        return self._processed + sum(deleter.processed_messages for deleter in self.deleters.values())
+
+    @property
+    def failed_messages(self):
+        return self._failed + sum(deleter.failed_messages for deleter in self.deleters.values())
+
+    def format_progress(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        rate = (self.deleted_messages - self.deleted_at_start) / elapsed
+        eta = None
+        if self.finished_channels:
+            # Rough, channels differ a lot in size
+            eta = (self.channels - self.finished_channels) * elapsed / self.finished_channels
+        return (f"{self.deleted_messages} deleted, {self.failed_messages} failed, "
+                f"{self.processed_messages} scanned, {self.finished_channels}/{self.channels} channels done, "
+                f"{rate:.1f} deletes/s, ETA {format_duration(eta)}")
+
+    async def delete_messages(self, guild, message_filter, channel, job=None):
+        """Delete the messages matching the filter across the guild. `channel` is
+        where the command was issued. Passing a stored job resumes it."""
+        self.deletion_in_progress = True
+        self._deleted = 0
+        self._processed = 0
+        self._failed = 0
+        self.finished_channels = 0
+        self.interrupted = False  # Whether a channel stopped on a transient error
+        self.started = time.monotonic()
+        if job is None:
+            job = job_store.create_job(channel, message_filter, scope='guild')
+        self.job = job
+        self.job_id = job['id']
+        children = {child['channel_id']: child for child in job_store.child_jobs(self.job_id)}
+        status = 'failed'
+        start_time = datetime.now()
+        prefix = f"[{guild.name}]"
+        try:
+            channels = await collect_guild_channels(guild, prefix)
+            self.channels = len(channels)
+            self.deleted_at_start = sum(child['deleted'] for child in children.values())
+            print(f"{prefix} Deleting messages from {message_filter} in {len(channels)} channels and threads.")
+            semaphore = asyncio.Semaphore(GUILD_CONCURRENCY)
+            tasks = [
+                asyncio.create_task(self._delete_in_channel(semaphore, channel, message_filter, children.get(channel.id)))
+                for channel in channels
+            ]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                # No channel keeps deleting once the guild job is over
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+            if self.cancel_requested:
+                status = 'cancelled'
+            elif self.interrupted:
+                # The interrupted channels are still running in the job store
+                print(f"{prefix} Guild job {self.job_id} was interrupted, it will be resumed.")
+                status = None
+            else:
+                status = 'done'
+
+        except asyncio.CancelledError:
+            # The bot is shutting down, leave the job to be resumed on restart
+            status = None
+            raise
 
         finally:
+            job_store.checkpoint(self.job_id, None, self.processed_messages, self.deleted_messages)
+            if status:
+                job_store.finish_job(self.job_id, status)
             self.deletion_in_progress = False
             end_time = datetime.now()
             duration = (end_time - start_time).total_seconds()
-            print(f"{prefix} Deletion process started at {start_time} and ended at {end_time}.")
-            print(f"{prefix} Deleted {deleted_messages} messages from {user.name} in {duration:.2f} seconds.")
+            print(f"{prefix} Guild deletion process started at {start_time} and ended at {end_time}.")
+            print(f"{prefix} Deleted {self.deleted_messages} messages from {message_filter} in {duration:.2f} seconds.")
+
+    async def _delete_in_channel(self, semaphore, channel, message_filter, child):
+        if child is not None and child['status'] != 'running':
+            # Finished before the restart
+            self._deleted += child['deleted']
+            self._processed += child['scanned']
+            self.finished_channels += 1
+            return
+
+        async with semaphore:
+            # Wait for room under the scheduler's cap and for other jobs in the channel to finish
+            deleter = MessageDeleter()
+            if not await scheduler.wait_for_channel(self.job, channel, deleter):
+                return
+            if self.cancel_requested:
+                scheduler.release_channel(channel.id, deleter)
+                return
+
+            self.deleters[channel.id] = deleter
+            try:
+                await deleter.delete_messages(channel, message_filter, job=child, parent_id=self.job_id)
+            except TRANSIENT_ERRORS:
+                # The channel's job stays resumable, so does the guild job
+                self.interrupted = True
+            except discord.errors.DiscordException as e:
+                print(f"[{channel.guild.name}/{channel.name}] DiscordException: {e}")
+            except Exception as e:
+                print(f"[{channel.guild.name}/{channel.name}] Unexpected exception: {e}")
+            finally:
+                del self.deleters[channel.id]
+                self._deleted += deleter.deleted_messages
+                self._processed += deleter.processed_messages
+                self._failed += deleter.failed_messages
+                self.finished_channels += 1
+                scheduler.release_channel(channel.id, deleter)
+
+# How many channels are deleted from at the same time across all guilds, whether by
+# channel jobs or by the channels of guild jobs. The rest waits in the queue.
+MAX_RUNNING_JOBS = int(os.getenv('MAX_RUNNING_JOBS', 10))
+
+class ScheduledJob:
+    """A deletion job the scheduler knows about, queued or running."""
 
-# Dictionary to keep track of deletion processes per channel
-channel_deleters = {}
+    def __init__(self, record, channel, message_filter, start_from_id=None, guild=None):
+        self.id = record['id']
+        self.record = record
+        self.scope = record['scope']
+        self.priority = record['priority']
+        self.channel = channel  # For guild jobs, where the command was issued, None if it's gone
+        self.guild = guild or channel.guild
+        self.message_filter = message_filter
+        self.start_from_id = start_from_id
+        self.deleter = None  # Set once the job runs
+        self.task = None
+
+    @property
+    def prefix(self):
+        if self.scope == 'guild':
+            return f"[{self.guild.name}]"
+        return f"[{self.guild.name}/{self.channel.name}]"
+
+class ChannelClaim:
+    """A channel of a running guild job waiting for its turn. It queues with
+    the guild job's priority and id, and `started` resolves to whether it runs."""
+
+    scope = 'claim'
+
+    def __init__(self, record, channel, deleter):
+        self.id = record['id']
+        self.priority = record['priority']
+        self.channel = channel
+        self.guild = channel.guild
+        self.deleter = deleter
+        self.started = asyncio.get_running_loop().create_future()
+
+class JobScheduler:
+    """Queues deletion jobs and deletes from at most `max_running` channels at a time.
+
+    A channel job takes one slot while it runs. A guild job takes a slot for
+    every channel it is deleting from, the channels queue up behind it with
+    its priority. Only one job runs in a channel at a time, and only one
+    guild job per guild. Queued jobs start in priority order, then in the
+    order they came in, taking turns between guilds so one busy guild can't
+    starve the rest."""
+
+    def __init__(self, max_running):
+        self.max_running = max_running
+        self.jobs = {}  # Job id -> ScheduledJob, queued and running
+        self.queues = {}  # Guild id -> queued jobs and channel claims of the guild, in the order they start
+        self.guild_order = collections.deque()  # Round robin over guilds with queued jobs
+        self.running = 0  # Channels being deleted from
+        self.channels = {}  # Channel id -> MessageDeleter running there, guild job channels included
+        self.guild_jobs = {}  # Guild id -> running guild job
+
+    def submit(self, channel, message_filter, scope='channel', start_from_id=None, priority=0):
+        cursor = min(filter(None, (start_from_id, message_filter.before)), default=None)
+        record = job_store.create_job(channel, message_filter, cursor, scope=scope, status='queued', priority=priority)
+        return self.resume(record, channel, message_filter, start_from_id)
+
+    def resume(self, record, channel, message_filter, start_from_id=None, guild=None):
+        """Queue a stored job. Jobs the scheduler already has are left alone."""
+        if record['id'] in self.jobs:
+            return self.jobs[record['id']]
+        job = ScheduledJob(record, channel, message_filter, start_from_id, guild)
+        self.jobs[job.id] = job
+        self._enqueue(job)
+        self._dispatch()
+        return job
+
+    async def wait_for_channel(self, record, channel, deleter):
+        """Wait until the guild job of `record` may delete from the channel. Returns
+        False if the job was cancelled first, otherwise the caller releases the channel."""
+        claim = ChannelClaim(record, channel, deleter)
+        self._enqueue(claim)
+        self._dispatch()
+        try:
+            return await claim.started
+        except asyncio.CancelledError:
+            if claim.started.done() and not claim.started.cancelled():
+                # Started just as the guild job was stopped
+                self.release_channel(channel.id, deleter)
+            else:
+                self._dequeue(claim)
+            raise
+
+    def queued(self, guild_id):
+        return [job for job in self.queues.get(guild_id, ()) if isinstance(job, ScheduledJob)]
+
+    def running_jobs(self, guild_id):
+        return [job for job in self.jobs.values() if job.deleter and job.guild.id == guild_id]
+
+    def cancel(self, job):
+        """Drop a queued job, or ask a running one to stop."""
+        if job.deleter:
+            job.deleter.cancel_requested = True
+            if job.scope == 'guild':
+                # Channels still waiting for a slot don't start at all
+                for claim in list(self.queues.get(job.guild.id, ())):
+                    if claim.scope == 'claim' and claim.id == job.id:
+                        self._dequeue(claim)
+                        claim.started.set_result(False)
+            return
+        self._dequeue(job)
+        del self.jobs[job.id]
+        job_store.finish_job(job.id, 'cancelled')
+
+    def release_channel(self, channel_id, deleter):
+        if self.channels.get(channel_id) is deleter:
+            del self.channels[channel_id]
+            self.running -= 1
+            self._dispatch()
+
+    def _enqueue(self, job):
+        queue = self.queues.setdefault(job.guild.id, [])
+        queue.append(job)
+        queue.sort(key=lambda queued: (-queued.priority, queued.id))
+        if job.guild.id not in self.guild_order:
+            self.guild_order.append(job.guild.id)
+
+    def _dequeue(self, job):
+        queue = self.queues[job.guild.id]
+        queue.remove(job)
+        if not queue:
+            del self.queues[job.guild.id]
+            self.guild_order.remove(job.guild.id)
+
+    def _can_start(self, job):
+        if job.scope == 'guild':
+            return job.guild.id not in self.guild_jobs
+        if job.scope == 'claim' and job.started.done():
+            # Its guild job was stopped, it is about to leave the queue
+            return False
+        return job.channel.id not in self.channels
+
+    def _dispatch(self):
+        """Start queued jobs while there is room, one per guild in turn."""
+        skipped = 0  # Guilds in a row with nothing that can start right now
+        while self.running < self.max_running and skipped < len(self.guild_order):
+            guild_id = self.guild_order[0]
+            self.guild_order.rotate(-1)
+            job = next((queued for queued in self.queues[guild_id] if self._can_start(queued)), None)
+            if job is None:
+                skipped += 1
+                continue
+            skipped = 0
+            self._dequeue(job)
+            self._start(job)
+
+    def _claim_channel(self, channel_id, deleter):
+        self.channels[channel_id] = deleter
+        self.running += 1
+
+    def _start(self, job):
+        if job.scope == 'claim':
+            self._claim_channel(job.channel.id, job.deleter)
+            job.started.set_result(True)
+            return
+        if job.scope == 'guild':
+            # The guild job itself takes no slot, its channels do
+            job.deleter = GuildDeleter()
+            self.guild_jobs[job.guild.id] = job
+        else:
+            job.deleter = MessageDeleter()
+            self._claim_channel(job.channel.id, job.deleter)
+        job_store.start_job(job.id)
+        job.task = asyncio.create_task(self._run(job))
+
+    async def _run(self, job):
+        try:
+            if job.scope == 'guild':
+                await job.deleter.delete_messages(job.guild, job.message_filter, job.channel, job.record)
+                print(f"{job.prefix} Completed guild deletion process for {job.message_filter}.")
+            else:
+                await job.deleter.delete_messages(job.channel, job.message_filter, job.start_from_id, job.record)
+                print(f"{job.prefix} Completed deletion process for {job.message_filter}.")
+        except Exception as e:
+            print(f"{job.prefix} An error occurred in job {job.id}: {e}")
+        finally:
+            del self.jobs[job.id]
+            if job.scope == 'guild':
+                del self.guild_jobs[job.guild.id]
+                self._dispatch()
+            else:
+                self.release_channel(job.channel.id, job.deleter)
+
+scheduler = JobScheduler(MAX_RUNNING_JOBS)
+
+async def resume_job(job):
+    """Queue a stored job again after a restart, it picks up from its checkpoint."""
+    message_filter = MessageFilter.from_job(job)
+    if job['scope'] == 'guild':
+        # The channel the command was issued in may be gone by now, often is after a raid
+        guild = bot.get_guild(job['guild_id'])
+        if guild is None:
+            print(f"Cannot resume guild job {job['id']}: the bot is not in guild {job['guild_id']} any more.")
+            job_store.finish_job(job['id'], 'failed')
+        elif guild.unavailable:
+            print(f"Cannot resume guild job {job['id']} yet: guild {job['guild_id']} is unavailable.")
+        else:
+            print(f"[{guild.name}] Resuming guild job {job['id']} for {message_filter}")
+            scheduler.resume(job, guild.get_channel(job['channel_id']), message_filter, guild=guild)
+        return
+
+    try:
+        channel = bot.get_channel(job['channel_id']) or await bot.fetch_channel(job['channel_id'])
+    except (discord.errors.NotFound, discord.errors.Forbidden) as e:
+        # The channel is gone or out of reach for good
+        print(f"Cannot resume job {job['id']}: {e}")
+        job_store.finish_job(job['id'], 'failed')
+        return
+    except (discord.errors.DiscordException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        # Likely temporary, the job stays unfinished and the next on_ready tries again
+        print(f"Cannot resume job {job['id']} yet: {e}")
+        return
+    print(f"[{channel.guild.name}/{channel.name}] Resuming job {job['id']} for {message_filter} from message ID: {job['cursor']}")
+    scheduler.resume(job, channel, message_filter)
+
+# Whether the metrics server has been started, on_ready can fire more than once
+metrics_server_started = False
 
 @bot.event
 async def on_ready():
+    global metrics_server_started
     print(f"Bot is ready. Logged in as {bot.user}")
+    if METRICS_PORT and not metrics_server_started:
+        metrics_server_started = True
+        await start_metrics_server()
+    # Everything posted from now on reaches on_message, a new session means a gap
+    message_index.start_live(discord.utils.time_snowflake(discord.utils.utcnow()))
+    # on_ready fires again after reconnects, the scheduler skips jobs it already has
+    for job in job_store.unfinished_jobs():
+        if job['id'] not in scheduler.jobs:
+            asyncio.create_task(resume_job(job))
+
+class SnowflakeConverter(commands.Converter):
+    """Accepts a message ID or an ISO date (UTC unless it says otherwise) and returns a snowflake."""
+
+    async def convert(self, ctx, argument):
+        if argument.isdigit():
+            return int(argument)
+        try:
+            date = datetime.fromisoformat(argument)
+        except ValueError:
+            raise commands.BadArgument(f"{argument} is neither a message ID nor a date.")
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+        return discord.utils.time_snowflake(date)
+
+class JobFlags(commands.FlagConverter):
+    """Optional bounds, content predicates and priority, e.g. `after: 2024-05-01 links: yes priority: 1`."""
+    after: typing.Optional[SnowflakeConverter] = None
+    before: typing.Optional[SnowflakeConverter] = None
+    regex: typing.Optional[str] = None
+    attachments: bool = False
+    links: bool = False
+    priority: int = 0  # Higher runs first among queued jobs
+
+def build_filter(users, flags):
+    try:
+        return MessageFilter(
+            {user.id: user.name for user in users},
+            after=flags.after,
+            before=flags.before,
+            pattern=flags.regex,
+            attachments=flags.attachments,
+            links=flags.links,
+        )
+    except re.error as e:
+        raise commands.BadArgument(f"Invalid regex: {e}")
 
 @bot.command()
 @commands.has_permissions(manage_messages=True)
-async def d(ctx, user: discord.User, message_id: int = None):
-    """Delete all messages of a specified user in the current channel.
-    Optionally specify a message ID to start deletion from."""
+async def d(ctx, users: commands.Greedy[discord.User], message_id: typing.Optional[int] = None, *, flags: JobFlags):
+    """Delete all messages of the specified users in the current channel.
+    Optionally specify a message ID to start deletion from, and flags
+    (after, before, regex, attachments, links) to narrow down what is deleted."""
     prefix = f"[{ctx.guild.name}/{ctx.channel.name}]"
-    deleter = channel_deleters.get(ctx.channel.id)
-    if deleter and deleter.deletion_in_progress:
-        print(f"{prefix} A deletion process is already in progress in this channel. Please wait until it finishes.")
+    if not users:
+        print(f"{prefix} No users specified.")
         return
-
-    deleter = MessageDeleter()
-    channel_deleters[ctx.channel.id] = deleter
+    message_filter = build_filter(users, flags)
 
     try:
         await ctx.message.delete()  # Delete the command message
@@ -126,19 +1459,100 @@ async def d(ctx, user: discord.User, message_id: int = None):
     except Exception as e:
         print(f"{prefix} Unexpected exception: {e}")
 
-    await deleter.delete_messages(ctx.channel, user, message_id)
-    print(f"{prefix} Completed deletion process for {user.name}.")
+    job = scheduler.submit(ctx.channel, message_filter, start_from_id=message_id, priority=flags.priority)
+    if not job.deleter:
+        print(f"{prefix} Job {job.id} for {message_filter} is queued.")
+
+@bot.listen('on_message')
+async def index_message(message):
+    message_index.add_live(message)
+
+@bot.listen('on_raw_message_delete')
+async def unindex_message(payload):
+    message_index.remove(payload.channel_id, [payload.message_id])
+
+@bot.listen('on_raw_bulk_message_delete')
+async def unindex_messages(payload):
+    message_index.remove(payload.channel_id, payload.message_ids)
+
+# Guilds with an index backfill in progress
+indexing_guilds = set()
+
+@bot.command()
+@commands.has_permissions(manage_messages=True)
+async def index(ctx):
+    """Backfill the message index for every channel and thread of the guild.
+    Deletion jobs read only the history the index doesn't cover."""
+    prefix = f"[{ctx.guild.name}]"
+    try:
+        await ctx.message.delete()  # Delete the command message
+    except discord.errors.DiscordException as e:
+        print(f"{prefix} Cannot delete the command message: {e}")
+
+    if ctx.guild.id in indexing_guilds:
+        print(f"{prefix} An index backfill is already in progress.")
+        return
+    indexing_guilds.add(ctx.guild.id)
+    start_time = datetime.now()
+    try:
+        channels = await collect_guild_channels(ctx.guild, prefix)
+        semaphore = asyncio.Semaphore(GUILD_CONCURRENCY)
+
+        async def backfill(channel):
+            async with semaphore:
+                indexed = 0
+                try:
+                    async for _ in message_index.scan(channel):
+                        indexed += 1
+                except discord.errors.DiscordException as e:
+                    print(f"[{ctx.guild.name}/{channel.name}] DiscordException while indexing: {e}")
+                print(f"[{ctx.guild.name}/{channel.name}] Indexed {indexed} messages.")
+
+        await asyncio.gather(*(backfill(channel) for channel in channels))
+    finally:
+        indexing_guilds.discard(ctx.guild.id)
+    duration = (datetime.now() - start_time).total_seconds()
+    print(f"{prefix} Index backfill of {len(channels)} channels finished in {duration:.2f} seconds.")
+
+@bot.command()
+@commands.has_permissions(manage_messages=True)
+async def dg(ctx, users: commands.Greedy[discord.User], *, flags: JobFlags):
+    """Delete all messages of the specified users in every channel and thread of the guild.
+    Takes the same flags as `!d`."""
+    prefix = f"[{ctx.guild.name}]"
+    if not users:
+        print(f"{prefix} No users specified.")
+        return
+    message_filter = build_filter(users, flags)
+
+    try:
+        await ctx.message.delete()  # Delete the command message
+    except discord.errors.Forbidden:
+        print(f"{prefix} Forbidden: Cannot delete the command message in {ctx.channel.name}")
+    except discord.errors.NotFound:
+        print(f"{prefix} NotFound: Command message already deleted in {ctx.channel.name}")
+    except discord.errors.DiscordException as e:
+        print(f"{prefix} DiscordException: {e}")
+    except Exception as e:
+        print(f"{prefix} Unexpected exception: {e}")
 
-    # Clean up the deleter for this channel
-    if ctx.channel.id in channel_deleters:
-        del channel_deleters[ctx.channel.id]
+    job = scheduler.submit(ctx.channel, message_filter, scope='guild', priority=flags.priority)
+    if not job.deleter:
+        print(f"{prefix} Guild job {job.id} for {message_filter} is queued.")
 
 @bot.command()
 @commands.has_permissions(manage_messages=True)
-async def cancel(ctx):
-    """Cancel the current deletion process in this channel."""
+async def cancel(ctx, target: str = 'channel'):
+    """Cancel the running and queued deletion jobs in this channel.
+    Use `!cancel guild` for guild wide jobs, or `!cancel <job id>` for one job."""
     prefix = f"[{ctx.guild.name}/{ctx.channel.name}]"
-    deleter = channel_deleters.get(ctx.channel.id)
+    jobs = scheduler.running_jobs(ctx.guild.id) + scheduler.queued(ctx.guild.id)
+    if target.isdigit():
+        jobs = [job for job in jobs if job.id == int(target)]
+    elif target == 'guild':
+        jobs = [job for job in jobs if job.scope == 'guild']
+    else:
+        jobs = [job for job in jobs if job.scope == 'channel' and job.channel.id == ctx.channel.id]
 
     try:
         await ctx.message.delete()  # Delete the cancel command message
@@ -151,13 +1565,76 @@ async def cancel(ctx):
     except Exception as e:
         print(f"{prefix} Unexpected exception: {e}")
 
-    if not deleter or not deleter.deletion_in_progress:
-        print(f"{prefix} No deletion process is currently in progress in this channel.")
+    if not jobs:
+        print(f"{prefix} No deletion job to cancel for {target}.")
         return
-    deleter.cancel_requested = True
-    print(f"{prefix} Cancellation requested for the deletion process in this channel.")
+    for job in jobs:
+        state = 'running' if job.deleter else 'queued'
+        scheduler.cancel(job)
+        print(f"{prefix} Cancellation requested for {state} job {job.id}.")
+
+@bot.command()
+@commands.has_permissions(manage_messages=True)
+async def jobs(ctx):
+    """List the running and queued deletion jobs of this guild."""
+    prefix = f"[{ctx.guild.name}]"
+    try:
+        await ctx.message.delete()  # Delete the command message
+    except discord.errors.DiscordException as e:
+        print(f"{prefix} Cannot delete the command message: {e}")
+
+    running = scheduler.running_jobs(ctx.guild.id)
+    queued = scheduler.queued(ctx.guild.id)
+    if not running and not queued:
+        print(f"{prefix} No deletion jobs.")
+        return
+    for job in running:
+        print(f"{job.prefix} Job {job.id} running for {job.message_filter}: {job.deleter.format_progress()}")
+    for position, job in enumerate(queued, start=1):
+        print(f"{job.prefix} Job {job.id} queued at position {position} for {job.message_filter}, priority {job.priority}.")
+
+@bot.command()
+@commands.has_permissions(manage_messages=True)
+async def status(ctx, job_id: int = None):
+    """Show throughput and ETA of the running deletion jobs of this guild, or of one job."""
+    prefix = f"[{ctx.guild.name}]"
+    try:
+        await ctx.message.delete()  # Delete the command message
+    except discord.errors.DiscordException as e:
+        print(f"{prefix} Cannot delete the command message: {e}")
+
+    running = scheduler.running_jobs(ctx.guild.id)
+    if job_id is not None:
+        running = [job for job in running if job.id == job_id]
+    for job in running:
+        print(f"{job.prefix} Job {job.id} for {job.message_filter}: {job.deleter.format_progress()}")
+    if not running:
+        print(f"{prefix} No running deletion job{f' {job_id}' if job_id is not None else 's'}.")
+    print(f"{prefix} Since start: {metrics.summary()}. {len(scheduler.queued(ctx.guild.id))} jobs queued.")
+
+async def serve_metrics(request):
+    running = sum(1 for job in scheduler.jobs.values() if job.deleter)
+    gauges = {
+        'jobs_running': running,
+        'jobs_queued': len(scheduler.jobs) - running,
+        'channels_running': scheduler.running,
+    }
+    return web.Response(text=metrics.render(gauges), content_type='text/plain')
+
+async def start_metrics_server():
+    app = web.Application()
+    app.router.add_get('/metrics', serve_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, int(METRICS_PORT)).start()
+    print(f"Serving metrics at http://{METRICS_HOST}:{METRICS_PORT}/metrics")
 
 @d.error
+@dg.error
+@index.error
+@cancel.error
+@jobs.error
+@status.error
 async def d_error(ctx, error):
     prefix = f"[{ctx.guild.name}/{ctx.channel.name}]"
     if isinstance(error, commands.MissingPermissions):
@@ -165,5 +1642,6 @@ async def d_error(ctx, error):
     else:
         print(f"{prefix} An error occurred: {error}")
 
-# Run the bot
-bot.run(TOKEN)
+# Run the bot, importing the module (e.g. from benchmark.py) doesn't
+if __name__ == '__main__':
+    bot.run(TOKEN)
@@ -0,0 +1,31 @@
+import os
+import sys
+import sqlite3
+import tempfile
+
+import pytest
+
+# main opens its job store on import, keep it away from a real deleter.db
+os.environ['DB_PATH'] = os.path.join(tempfile.mkdtemp(), 'test.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+@pytest.fixture
+def db():
+    db = sqlite3.connect(':memory:')
+    db.row_factory = sqlite3.Row
+    yield db
+    db.close()
+
+@pytest.fixture
+def index(db, monkeypatch):
+    index = main.MessageIndex(db)
+    monkeypatch.setattr(main, 'message_index', index)
+    return index
+
+@pytest.fixture
+def store(monkeypatch):
+    store = main.JobStore(':memory:')
+    monkeypatch.setattr(main, 'job_store', store)
+    return store
@@ -0,0 +1,126 @@
+import asyncio
+from datetime import timedelta
+from types import SimpleNamespace
+
+import discord
+import pytest
+
+import main
+
+home = SimpleNamespace(id=1, name='guild')
+
+class FakeChannel:
+    """Records the bulk deletes it gets, or rejects them with `error`."""
+
+    def __init__(self, error=None):
+        self.id = 10
+        self.name = 'channel'
+        self.guild = home
+        self.error = error
+        self.batches = []
+        self.singles = []
+
+    async def delete_messages(self, messages):
+        if self.error:
+            raise self.error
+        self.batches.append([message.id for message in messages])
+
+def message(channel, days_ago, n=0):
+    created_at = discord.utils.utcnow() - timedelta(days=days_ago)
+    message_id = discord.utils.time_snowflake(created_at) + n
+
+    async def delete():
+        channel.singles.append(message_id)
+
+    return SimpleNamespace(id=message_id, created_at=created_at, channel=channel, delete=delete)
+
+def http_error(status, text):
+    return discord.errors.HTTPException(SimpleNamespace(status=status, reason=text), text)
+
+@pytest.fixture
+def deleter(store, index, monkeypatch):
+    monkeypatch.setattr(main, 'pacer', main.RateLimitPacer())
+    monkeypatch.setattr(main, 'BULK_LINGER', 0.01)
+    deleter = main.MessageDeleter()
+    deleter.job_id = store.create_job(FakeChannel(), main.MessageFilter({1: 'alice'}))['id']
+    return deleter
+
+def pend(store, deleter, messages):
+    for message in messages:
+        store.add_pending(deleter.job_id, message.id)
+
+def test_bulk_worker_splits_batches_at_100(store, deleter):
+    channel = FakeChannel()
+    messages = [message(channel, 1, n) for n in range(250)]
+    pend(store, deleter, messages)
+
+    async def run():
+        queue = asyncio.Queue()
+        for m in messages:
+            await queue.put(m)
+        await queue.put(None)
+        await deleter._bulk_worker(channel, queue, '[test]')
+
+    asyncio.run(run())
+    assert [len(batch) for batch in channel.batches] == [100, 100, 50]
+    assert channel.singles == []
+    assert deleter.deleted_messages == 250
+    assert store.pending_messages(deleter.job_id) == []
+
+def test_old_messages_are_queued_for_single_deletes(deleter):
+    channel = FakeChannel()
+
+    async def run():
+        bulk_queue, single_queue = asyncio.Queue(), asyncio.Queue()
+        await deleter._enqueue(message(channel, 1), bulk_queue, single_queue)
+        await deleter._enqueue(message(channel, 20), bulk_queue, single_queue)
+        return bulk_queue.qsize(), single_queue.qsize()
+
+    assert asyncio.run(run()) == (1, 1)
+    assert deleter.backlog == 2
+
+def test_messages_that_aged_out_in_the_queue_are_deleted_singly(store, deleter):
+    channel = FakeChannel()
+    recent = [message(channel, 1, n) for n in range(3)]
+    # Just past the bulk window, as if it had waited in the queue too long
+    aged = [message(channel, 14, n) for n in range(2)]
+    pend(store, deleter, recent + aged)
+
+    asyncio.run(deleter._bulk_delete(channel, recent + aged, '[test]'))
+    assert channel.batches == [[m.id for m in recent]]
+    assert channel.singles == [m.id for m in aged]
+    assert deleter.deleted_messages == 5
+    assert store.pending_messages(deleter.job_id) == []
+
+def test_one_message_batch_is_deleted_singly(deleter):
+    channel = FakeChannel()
+    only = message(channel, 1)
+
+    asyncio.run(deleter._bulk_delete(channel, [only], '[test]'))
+    # The bulk endpoint rejects fewer than two messages
+    assert channel.batches == []
+    assert channel.singles == [only.id]
+    assert deleter.deleted_messages == 1
+
+def test_rejected_batch_falls_back_to_single_deletes(store, deleter):
+    channel = FakeChannel(http_error(400, 'Bad Request'))
+    messages = [message(channel, 1, n) for n in range(5)]
+    pend(store, deleter, messages)
+
+    asyncio.run(deleter._bulk_delete(channel, messages, '[test]'))
+    assert channel.singles == [m.id for m in messages]
+    assert deleter.deleted_messages == 5
+    assert deleter.failed_messages == 0
+    assert store.pending_messages(deleter.job_id) == []
+
+def test_forbidden_batch_fails_without_single_deletes(store, deleter):
+    channel = FakeChannel(discord.errors.Forbidden(SimpleNamespace(status=403, reason='Forbidden'), 'Missing Permissions'))
+    messages = [message(channel, 1, n) for n in range(5)]
+    pend(store, deleter, messages)
+
+    asyncio.run(deleter._bulk_delete(channel, messages, '[test]'))
+    assert channel.singles == []
+    assert deleter.deleted_messages == 0
+    assert deleter.failed_messages == 5
+    # Retrying would get the same answer, they are not kept for a resume
+    assert store.pending_messages(deleter.job_id) == []
@@ -0,0 +1,40 @@
+import asyncio
+from unittest import mock
+
+import discord
+import pytest
+from discord.ext import commands
+
+import main
+
+async def fake_user(self, ctx, argument):
+    if argument.startswith('<@'):
+        return discord.Object(id=int(argument.strip('<@!>')))
+    raise commands.BadArgument(f"{argument} is not a user")
+
+def parse(command, text):
+    """Run the command's argument parsing on `text`, returns its arguments after ctx."""
+    message = mock.MagicMock(spec=discord.Message)
+    message.content = f'!{command.name} {text}'
+    message.mentions = []
+    ctx = commands.Context(message=message, bot=main.bot, view=commands.view.StringView(text), prefix='!', command=command)
+    with mock.patch.object(commands.converter.UserConverter, 'convert', fake_user):
+        asyncio.run(command._parse_arguments(ctx))
+    return ctx.args[1:], ctx.kwargs['flags']
+
+@pytest.mark.parametrize('command', [main.d, main.dg])
+def test_flags_without_message_id(command):
+    args, flags = parse(command, '<@1> <@2> after: 2024-05-01 links: yes priority: 2')
+    assert [user.id for user in args[0]] == [1, 2]
+    assert flags.after == discord.utils.time_snowflake(discord.utils.parse_time('2024-05-01T00:00:00+00:00'))
+    assert flags.links and flags.priority == 2
+
+def test_message_id_and_flags():
+    (users, message_id), flags = parse(main.d, '<@1> 12345 regex: spam')
+    assert message_id == 12345
+    assert flags.regex == 'spam'
+
+def test_no_message_id():
+    (users, message_id), flags = parse(main.d, '<@1>')
+    assert message_id is None
+    assert flags.after is None and not flags.links
@@ -0,0 +1,45 @@
+from types import SimpleNamespace
+
+import main
+
+def message(author_id, message_id=100, content='', attachments=()):
+    return SimpleNamespace(
+        id=message_id, author=SimpleNamespace(id=author_id), content=content, attachments=list(attachments),
+    )
+
+def test_round_trip_through_job_record():
+    message_filter = main.MessageFilter(
+        {1: 'alice', 2: 'bob'}, after=10, before=1000, pattern=r'free\s+nitro', attachments=True, links=True,
+    )
+    restored = main.MessageFilter.from_job({'filter': message_filter.to_json(), 'user_id': 1})
+    assert restored.users == {1: 'alice', 2: 'bob'}
+    assert restored.user_ids == {1, 2}
+    assert (restored.after, restored.before) == (10, 1000)
+    assert restored.pattern.pattern == r'free\s+nitro'
+    assert restored.attachments and restored.links
+    assert restored.to_json() == message_filter.to_json()
+
+def test_round_trip_without_options():
+    restored = main.MessageFilter.from_job({'filter': main.MessageFilter({5: 'eve'}).to_json(), 'user_id': 5})
+    assert restored.users == {5: 'eve'}
+    assert restored.after is None and restored.before is None and restored.pattern is None
+    assert not restored.needs_content
+
+def test_job_stored_before_filters():
+    restored = main.MessageFilter.from_job({'filter': None, 'user_id': 42})
+    assert restored.user_ids == {42}
+
+def test_matches():
+    message_filter = main.MessageFilter({1: 'alice'}, after=10, before=1000, pattern='spam', links=True)
+    assert message_filter.matches(message(1, content='spam at https://example.com'))
+    assert not message_filter.matches(message(2, content='spam at https://example.com'))
+    assert not message_filter.matches(message(1, content='spam'))
+    assert not message_filter.matches(message(1, content='ham at https://example.com'))
+    assert not message_filter.matches(message(1, message_id=10, content='spam at https://example.com'))
+    assert not message_filter.matches(message(1, message_id=1000, content='spam at https://example.com'))
+
+def test_attachments():
+    message_filter = main.MessageFilter({1: 'alice'}, attachments=True)
+    assert message_filter.needs_content
+    assert message_filter.matches(message(1, attachments=[object()]))
+    assert not message_filter.matches(message(1))
@@ -0,0 +1,67 @@
+from types import SimpleNamespace
+
+import main
+
+def coverage(index, channel_id):
+    rows = index.db.execute('SELECT lo, hi FROM index_coverage WHERE channel_id = ? ORDER BY lo', (channel_id,))
+    return [tuple(row) for row in rows]
+
+def live_message(channel_id, message_id):
+    return SimpleNamespace(
+        id=message_id, guild=object(), channel=SimpleNamespace(id=channel_id), author=SimpleNamespace(id=7),
+    )
+
+def test_gaps_without_coverage(index):
+    assert index.gaps(1, 100, 10) == [(10, 100)]
+
+def test_gaps_empty_range(index):
+    assert index.gaps(1, 50, 60) == []
+    index.add_coverage(1, 40, 70)
+    assert index.gaps(1, 50, 60) == []
+
+def test_gaps_around_coverage(index):
+    index.add_coverage(1, 20, 30)
+    index.add_coverage(1, 50, 60)
+    index.add_coverage(2, 0, 1000)
+    assert index.gaps(1, 100, 10) == [(61, 100), (31, 49), (10, 19)]
+    assert index.gaps(1, 55, 25) == [(31, 49)]
+    assert index.gaps(1, 60, 50) == []
+
+def test_add_coverage_merges_overlapping_and_adjacent_ranges(index):
+    index.add_coverage(1, 10, 20)
+    index.add_coverage(1, 30, 40)
+    index.add_coverage(1, 21, 29)
+    assert coverage(index, 1) == [(10, 40)]
+    index.add_coverage(1, 5, 15)
+    index.add_coverage(1, 35, 50)
+    assert coverage(index, 1) == [(5, 50)]
+    index.add_coverage(1, 60, 70)
+    assert coverage(index, 1) == [(5, 50), (60, 70)]
+
+def test_live_coverage_is_flushed_before_gaps(index):
+    index.start_live(100)
+    index.add_live(live_message(1, 150))
+    index.add_live(live_message(1, 120))
+    assert coverage(index, 1) == []
+    assert index.gaps(1, 200, 0) == [(151, 200), (0, 99)]
+    assert coverage(index, 1) == [(100, 150)]
+
+def test_live_coverage_is_flushed_every_page(index):
+    index.start_live(100)
+    for message_id in range(101, 101 + main.CHECKPOINT_INTERVAL):
+        index.add_live(live_message(1, message_id))
+    assert coverage(index, 1) == [(100, 100 + main.CHECKPOINT_INTERVAL)]
+
+def test_new_session_flushes_the_old_one(index):
+    index.start_live(100)
+    index.add_live(live_message(1, 150))
+    index.start_live(300)
+    index.add_live(live_message(1, 350))
+    index.flush_live()
+    assert coverage(index, 1) == [(100, 150), (300, 350)]
+
+def test_messages_by_author_within_bounds(index):
+    for message_id, author_id in ((10, 1), (20, 2), (30, 1), (40, 3), (50, 1)):
+        index.add(SimpleNamespace(id=message_id, channel=SimpleNamespace(id=9), author=SimpleNamespace(id=author_id)))
+    assert index.messages(9, {1}) == [50, 30, 10]
+    assert index.messages(9, {1, 3}, before=50, after=10) == [40, 30]
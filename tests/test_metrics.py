@@ -0,0 +1,40 @@
+import asyncio
+from types import SimpleNamespace
+
+import yarl
+
+import main
+
+def request(metrics, method, path, status):
+    params = SimpleNamespace(method=method, url=yarl.URL(f'https://discord.com/api/v10{path}'))
+    ctx = SimpleNamespace()
+    asyncio.run(metrics.on_request_start(None, ctx, params))
+    params.response = SimpleNamespace(status=status)
+    asyncio.run(metrics.on_request_end(None, ctx, params))
+
+def test_retries_are_counted_when_a_rate_limited_delete_is_sent_again():
+    metrics = main.Metrics()
+    request(metrics, 'DELETE', '/channels/1/messages/2', 429)
+    request(metrics, 'DELETE', '/channels/1/messages/2', 429)
+    request(metrics, 'DELETE', '/channels/1/messages/2', 204)
+    request(metrics, 'POST', '/channels/1/messages/bulk-delete', 429)
+    request(metrics, 'POST', '/channels/1/messages/bulk-delete', 204)
+    request(metrics, 'DELETE', '/channels/1/messages/3', 429)
+    assert metrics.counters['rate_limited'] == 4
+    assert metrics.counters['retries'] == 3
+
+def test_history_rate_limits_are_not_delete_retries():
+    metrics = main.Metrics()
+    request(metrics, 'GET', '/channels/1/messages', 429)
+    request(metrics, 'GET', '/channels/1/messages', 200)
+    assert metrics.counters['rate_limited'] == 1
+    assert metrics.counters['retries'] == 0
+
+def test_render():
+    metrics = main.Metrics()
+    request(metrics, 'DELETE', '/channels/1/messages/2', 204)
+    metrics.inc('deleted')
+    text = metrics.render({'jobs_running': 1})
+    assert 'deleter_deleted_total 1' in text
+    assert 'deleter_delete_latency_seconds_count{route="single"} 1' in text
+    assert 'deleter_jobs_running 1' in text
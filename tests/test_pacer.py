@@ -0,0 +1,105 @@
+import asyncio
+import time
+
+import main
+
+CHANNEL = 1
+
+async def timed(pacer, route='single', channel_id=CHANNEL):
+    """Seconds until a request of the bucket is granted."""
+    start = time.monotonic()
+    async with pacer.request(channel_id, route):
+        return time.monotonic() - start
+
+async def hold(pacer, release, route='single'):
+    """Hold a request of the bucket until `release` is set."""
+    async with pacer.request(CHANNEL, route):
+        await release.wait()
+
+def test_fresh_bucket_goes_right_away():
+    async def run():
+        pacer = main.RateLimitPacer()
+        assert await timed(pacer) < 0.01
+    asyncio.run(run())
+
+def test_route_429_blocks_only_its_bucket():
+    async def run():
+        pacer = main.RateLimitPacer()
+        pacer.update(CHANNEL, 'single', 429, {'Retry-After': '0.1', 'X-RateLimit-Scope': 'user'})
+        assert pacer.buckets[(CHANNEL, 'single')][0] == 0
+        assert await timed(pacer, 'bulk') < 0.01
+        assert await timed(pacer, 'single', channel_id=2) < 0.01
+        assert 0.08 < await timed(pacer) < 0.2
+    asyncio.run(run())
+
+def test_global_429_blocks_every_bucket():
+    async def run():
+        pacer = main.RateLimitPacer()
+        pacer.update(CHANNEL, 'single', 429, {'Retry-After': '0.1', 'X-RateLimit-Global': 'true'})
+        assert (CHANNEL, 'single') not in pacer.buckets
+        assert 0.08 < await timed(pacer, 'history', channel_id=2) < 0.2
+        pacer.update(CHANNEL, 'bulk', 429, {'Retry-After': '0.1', 'X-RateLimit-Scope': 'global'})
+        assert 0.08 < await timed(pacer, 'single') < 0.2
+    asyncio.run(run())
+
+def test_retry_after_falls_back_to_reset_after_then_one_second():
+    pacer = main.RateLimitPacer()
+    now = time.monotonic()
+    pacer.update(CHANNEL, 'single', 429, {'X-RateLimit-Reset-After': '3'})
+    assert 2.9 < pacer.buckets[(CHANNEL, 'single')][1] - now < 3.1
+    pacer.update(CHANNEL, 'single', 429, {})
+    assert 0.9 < pacer.buckets[(CHANNEL, 'single')][1] - now < 1.1
+
+def test_headers_set_the_bucket():
+    pacer = main.RateLimitPacer()
+    now = time.monotonic()
+    pacer.update(CHANNEL, 'history', 200, {'X-RateLimit-Remaining': '4', 'X-RateLimit-Reset-After': '2.5'})
+    remaining, reset_at = pacer.buckets[(CHANNEL, 'history')]
+    assert remaining == 4 and 2.4 < reset_at - now < 2.6
+    # Responses without rate limit headers leave the bucket alone
+    pacer.update(CHANNEL, 'history', 200, {})
+    assert pacer.buckets[(CHANNEL, 'history')][0] == 4
+
+def test_exhausted_bucket_waits_for_its_reset_and_expires():
+    async def run():
+        pacer = main.RateLimitPacer()
+        pacer.update(CHANNEL, 'single', 200, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset-After': '0.1'})
+        assert 0.08 < await timed(pacer) < 0.2
+        # The bucket reset since we last heard from it, so its state is forgotten
+        assert (CHANNEL, 'single') not in pacer.buckets
+    asyncio.run(run())
+
+def test_requests_in_flight_count_against_remaining():
+    async def run():
+        pacer = main.RateLimitPacer()
+        pacer.update(CHANNEL, 'single', 200, {'X-RateLimit-Remaining': '2', 'X-RateLimit-Reset-After': '5'})
+        release = asyncio.Event()
+        holders = [asyncio.create_task(hold(pacer, release)) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert pacer.in_flight[(CHANNEL, 'single')] == 2
+
+        third = asyncio.create_task(timed(pacer))
+        await asyncio.sleep(0.05)
+        assert not third.done()
+        release.set()
+        await asyncio.gather(*holders)
+        assert 0.04 < await third < 0.1
+        assert pacer.in_flight[(CHANNEL, 'single')] == 0
+    asyncio.run(run())
+
+def test_one_probe_while_the_bucket_is_unknown():
+    async def run():
+        pacer = main.RateLimitPacer()
+        release = asyncio.Event()
+        probe = asyncio.create_task(hold(pacer, release, 'history'))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(timed(pacer, 'history'))
+        await asyncio.sleep(0.05)
+        assert not second.done()
+
+        # The probe's response tells the pacer there is room, before the probe is released
+        pacer.update(CHANNEL, 'history', 200, {'X-RateLimit-Remaining': '4', 'X-RateLimit-Reset-After': '1'})
+        assert 0.04 < await second < 0.1
+        release.set()
+        await probe
+    asyncio.run(run())
@@ -0,0 +1,50 @@
+import asyncio
+from datetime import timedelta
+from types import SimpleNamespace
+
+import aiohttp
+import discord
+import pytest
+
+import main
+
+def snowflake(days_ago):
+    return discord.utils.time_snowflake(discord.utils.utcnow() - timedelta(days=days_ago))
+
+def test_failing_slice_stops_the_other_scanners(store, index, monkeypatch):
+    home = SimpleNamespace(id=1, name='guild')
+    channel = SimpleNamespace(id=snowflake(30), name='channel', guild=home, last_message_id=snowflake(0))
+    stranger = SimpleNamespace(id=2)
+    read_after_failure = []  # Messages scanners read after the failing slice broke the job
+    state = {'failed': False}
+
+    async def read(channel, lo, hi):
+        if lo == channel.id:
+            # The oldest slice breaks on its first page
+            await asyncio.sleep(0.01)
+            state['failed'] = True
+            raise aiohttp.ClientOSError('connection reset')
+        message_id = hi
+        while message_id >= lo:
+            await asyncio.sleep(0.001)
+            if state['failed']:
+                read_after_failure.append(message_id)
+            yield SimpleNamespace(id=message_id, author=stranger, content='', attachments=[])
+            message_id -= 1 << 22
+
+    monkeypatch.setattr(index, 'read', read)
+
+    async def run():
+        deleter = main.MessageDeleter()
+        with pytest.raises(aiohttp.ClientOSError):
+            await deleter.delete_messages(channel, main.MessageFilter({1: 'alice'}))
+        seen = len(read_after_failure)
+        await asyncio.sleep(0.05)
+        assert len(read_after_failure) == seen
+        assert asyncio.all_tasks() == {asyncio.current_task()}
+        return deleter.job_id
+
+    job_id = asyncio.run(run())
+    # Interrupted, not failed: the job and its slices are kept for a resume
+    assert store.get_job(job_id)['status'] == 'running'
+    assert store.job_slices(job_id)
@@ -0,0 +1,285 @@
+import asyncio
+from types import SimpleNamespace
+
+import aiohttp
+import pytest
+
+import main
+
+RealMessageDeleter = main.MessageDeleter
+
+class FakeDeleter:
+    """Stands in for MessageDeleter, runs until the test finishes it."""
+
+    def __init__(self):
+        self.cancel_requested = False
+        self.channel = None
+        self.done = asyncio.Event()
+        self.deleted_messages = 0
+        self.processed_messages = 0
+        self.failed_messages = 0
+
+    async def delete_messages(self, channel, message_filter, *args, **kwargs):
+        self.channel = channel
+        if channel.id in failing:
+            raise aiohttp.ClientOSError('connection reset')
+        running.append(self)
+        try:
+            await self.done.wait()
+        finally:
+            running.remove(self)
+
+running = []  # FakeDeleters currently deleting, in the order they started
+failing = set()  # Channel ids whose deleters fail with a network error
+
+def guild(guild_id):
+    return SimpleNamespace(id=guild_id, name=f'guild{guild_id}')
+
+def channel(channel_id, guild):
+    return SimpleNamespace(id=channel_id, name=f'channel{channel_id}', guild=guild)
+
+def running_channels():
+    return [deleter.channel.id for deleter in running]
+
+async def settle():
+    for _ in range(20):
+        await asyncio.sleep(0)
+
+async def finish(channel_id):
+    next(deleter for deleter in running if deleter.channel.id == channel_id).done.set()
+    await settle()
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    running.clear()
+    failing.clear()
+    monkeypatch.setattr(main, 'MessageDeleter', FakeDeleter)
+    monkeypatch.setattr(main, 'job_store', main.JobStore(':memory:'))
+    scheduler = main.JobScheduler(2)
+    monkeypatch.setattr(main, 'scheduler', scheduler)
+    return scheduler
+
+def submit(scheduler, target, scope='channel', priority=0):
+    return scheduler.submit(target, main.MessageFilter({1: 'alice'}), scope=scope, priority=priority)
+
+def test_cap_and_queue_order(scheduler):
+    async def run():
+        home = guild(1)
+        jobs = [submit(scheduler, channel(10 + i, home)) for i in range(3)]
+        urgent = submit(scheduler, channel(20, home), priority=1)
+        await settle()
+        assert running_channels() == [10, 11]
+        assert scheduler.queued(home.id) == [urgent, jobs[2]]
+        await finish(10)
+        assert running_channels() == [11, 20]
+        await finish(11)
+        assert running_channels() == [20, 12]
+        assert main.job_store.get_job(jobs[2].id)['status'] == 'running'
+    asyncio.run(run())
+
+def test_one_job_per_channel(scheduler):
+    async def run():
+        home = guild(1)
+        first = submit(scheduler, channel(10, home))
+        second = submit(scheduler, channel(10, home))
+        other = submit(scheduler, channel(11, home))
+        await settle()
+        assert running_channels() == [10, 11]
+        assert scheduler.queued(home.id) == [second]
+        await finish(10)
+        assert running_channels() == [11, 10]
+        assert first.id not in scheduler.jobs and other.deleter
+    asyncio.run(run())
+
+def test_guilds_take_turns(scheduler):
+    async def run():
+        scheduler.max_running = 1
+        busy, quiet = guild(1), guild(2)
+        submit(scheduler, channel(30, guild(3)))
+        for i in range(3):
+            submit(scheduler, channel(10 + i, busy))
+        submit(scheduler, channel(20, quiet))
+        await settle()
+        started = []
+        for _ in range(5):
+            started += running_channels()
+            await finish(running_channels()[0])
+        assert started == [30, 10, 20, 11, 12]
+    asyncio.run(run())
+
+def test_cancel_queued_job(scheduler):
+    async def run():
+        home = guild(1)
+        submit(scheduler, channel(10, home))
+        submit(scheduler, channel(11, home))
+        queued = submit(scheduler, channel(12, home))
+        scheduler.cancel(queued)
+        assert scheduler.queued(home.id) == []
+        assert queued.id not in scheduler.jobs
+        assert main.job_store.get_job(queued.id)['status'] == 'cancelled'
+    asyncio.run(run())
+
+def test_guild_job_channels_count_against_the_cap(scheduler, monkeypatch):
+    async def run():
+        home, other = guild(1), guild(2)
+        channels = [channel(10 + i, home) for i in range(4)]
+
+        async def collect(guild, prefix):
+            return channels
+        monkeypatch.setattr(main, 'collect_guild_channels', collect)
+
+        guild_job = submit(scheduler, channels[0], scope='guild')
+        await settle()
+        assert running_channels() == [10, 11]
+        assert scheduler.running == 2
+
+        # A job in another guild takes turns with the guild job's channels
+        submit(scheduler, channel(20, other))
+        await settle()
+        assert running_channels() == [10, 11]
+        await finish(10)
+        assert running_channels() == [11, 12]
+        await finish(11)
+        assert running_channels() == [12, 20]
+        await finish(20)
+        assert running_channels() == [12, 13]
+        await finish(12)
+        await finish(13)
+        await settle()
+        assert guild_job.id not in scheduler.jobs
+        assert scheduler.running == 0
+        assert main.job_store.get_job(guild_job.id)['status'] == 'done'
+    asyncio.run(run())
+
+def test_guild_job_waits_for_a_busy_channel(scheduler, monkeypatch):
+    async def run():
+        home = guild(1)
+        channels = [channel(10, home), channel(11, home)]
+
+        async def collect(guild, prefix):
+            return channels
+        monkeypatch.setattr(main, 'collect_guild_channels', collect)
+
+        scheduler.max_running = 3
+        submit(scheduler, channels[0])
+        submit(scheduler, channels[0], scope='guild')
+        await settle()
+        # Channel 10 is taken by the channel job, the guild job goes on with channel 11
+        assert running_channels() == [10, 11]
+        await finish(10)
+        assert running_channels() == [11, 10]
+    asyncio.run(run())
+
+def test_cancel_guild_job_drops_waiting_channels(scheduler, monkeypatch):
+    async def run():
+        home = guild(1)
+        channels = [channel(10 + i, home) for i in range(4)]
+
+        async def collect(guild, prefix):
+            return channels
+        monkeypatch.setattr(main, 'collect_guild_channels', collect)
+
+        guild_job = submit(scheduler, channels[0], scope='guild')
+        await settle()
+        assert running_channels() == [10, 11]
+        scheduler.cancel(guild_job)
+        assert all(deleter.cancel_requested for deleter in running)
+        await finish(10)
+        await finish(11)
+        await settle()
+        assert running_channels() == []
+        assert guild_job.id not in scheduler.jobs
+        assert scheduler.queues == {} and scheduler.running == 0
+        assert main.job_store.get_job(guild_job.id)['status'] == 'cancelled'
+    asyncio.run(run())
+
+def test_guild_job_interrupted_by_a_network_error_stays_resumable(scheduler, monkeypatch):
+    async def run():
+        home = guild(1)
+        channels = [channel(10 + i, home) for i in range(3)]
+
+        async def collect(guild, prefix):
+            return channels
+        monkeypatch.setattr(main, 'collect_guild_channels', collect)
+
+        failing.add(10)
+        guild_job = submit(scheduler, channels[0], scope='guild')
+        await settle()
+        # The other channels go on
+        assert running_channels() == [11, 12]
+        await finish(11)
+        await finish(12)
+        await settle()
+        assert guild_job.id not in scheduler.jobs
+        assert scheduler.running == 0
+        assert main.job_store.get_job(guild_job.id)['status'] == 'running'
+        assert [job['id'] for job in main.job_store.unfinished_jobs()] == [guild_job.id]
+    asyncio.run(run())
+
+def test_guild_job_resumes_without_the_command_channel(scheduler, monkeypatch):
+    async def run():
+        home = guild(1)
+        home.unavailable = False
+        home.get_channel = lambda channel_id: None  # The command channel was deleted
+        channels = [channel(11, home)]
+
+        async def collect(guild, prefix):
+            return channels
+        monkeypatch.setattr(main, 'collect_guild_channels', collect)
+        monkeypatch.setattr(main.bot, 'get_guild', lambda guild_id: home if guild_id == home.id else None)
+
+        record = main.job_store.create_job(channel(10, home), main.MessageFilter({1: 'alice'}), scope='guild')
+        await main.resume_job(record)
+        await settle()
+        assert scheduler.jobs[record['id']].guild is home
+        assert running_channels() == [11]
+        await finish(11)
+        assert main.job_store.get_job(record['id'])['status'] == 'done'
+    asyncio.run(run())
+
+def test_guild_job_of_a_guild_the_bot_left_fails(scheduler, monkeypatch):
+    async def run():
+        monkeypatch.setattr(main.bot, 'get_guild', lambda guild_id: None)
+        record = main.job_store.create_job(channel(10, guild(1)), main.MessageFilter({1: 'alice'}), scope='guild')
+        await main.resume_job(record)
+        assert record['id'] not in scheduler.jobs
+        assert main.job_store.get_job(record['id'])['status'] == 'failed'
+    asyncio.run(run())
+
+def test_cancel_right_after_submit(scheduler, index, monkeypatch):
+    async def run():
+        monkeypatch.setattr(main, 'MessageDeleter', RealMessageDeleter)
+        reads = []
+
+        async def read(channel, lo, hi):
+            reads.append((lo, hi))
+            return
+            yield
+        monkeypatch.setattr(index, 'read', read)
+
+        target = channel(10, guild(1))
+        target.last_message_id = None
+        job = submit(scheduler, target)
+        # _dispatch started the job, its task hasn't run yet
+        assert job.deleter and not job.task.done()
+        scheduler.cancel(job)
+        await asyncio.wait_for(job.task, 1)
+        assert reads == []
+        assert main.job_store.get_job(job.id)['status'] == 'cancelled'
+    asyncio.run(run())
+
+def test_cancel_guild_job_right_after_submit(scheduler, monkeypatch):
+    async def run():
+        home = guild(1)
+        channels = [channel(10, home)]
+
+        async def collect(guild, prefix):
+            return channels
+        monkeypatch.setattr(main, 'collect_guild_channels', collect)
+
+        job = submit(scheduler, channels[0], scope='guild')
+        scheduler.cancel(job)
+        await asyncio.wait_for(job.task, 1)
+        assert running == []
+        assert main.job_store.get_job(job.id)['status'] == 'cancelled'
+    asyncio.run(run())
@@ -0,0 +1,66 @@
+from datetime import timedelta
+from types import SimpleNamespace
+
+import discord
+
+import main
+
+def snowflake(days_ago):
+    return discord.utils.time_snowflake(discord.utils.utcnow() - timedelta(days=days_ago))
+
+def channel(days_old=30, last_message_days_ago=0):
+    return SimpleNamespace(id=snowflake(days_old), last_message_id=snowflake(last_message_days_ago))
+
+def plan(channel, message_filter, cursor=None):
+    deleter = main.MessageDeleter()
+    deleter.last_message_id = cursor
+    return deleter, deleter._plan_slices(channel, message_filter)
+
+def assert_contiguous(slices, lo, hi):
+    """Slices are newest first and cover lo..hi without holes or overlaps."""
+    assert slices[0].cursor == hi + 1
+    for newer, older in zip(slices, slices[1:]):
+        assert newer.lo == older.cursor
+    assert slices[-1].lo == lo
+
+def test_whole_history_is_split_evenly(index):
+    target = channel()
+    deleter, slices = plan(target, main.MessageFilter({1: 'alice'}))
+    assert len(slices) == main.SCAN_CONCURRENCY
+    assert_contiguous(slices, target.id, deleter.last_message_id - 1)
+
+def test_cursor_and_after_bound_the_scan(index):
+    target = channel()
+    after, cursor = snowflake(20), snowflake(10)
+    _, slices = plan(target, main.MessageFilter({1: 'alice'}, after=after), cursor)
+    assert_contiguous(slices, after + 1, cursor - 1)
+
+def test_only_gaps_in_the_index_are_read(index):
+    target = channel()
+    covered_lo, covered_hi = snowflake(20), snowflake(10)
+    index.add_coverage(target.id, covered_lo, covered_hi)
+    cursor = snowflake(1)
+    _, slices = plan(target, main.MessageFilter({1: 'alice'}), cursor)
+    assert slices
+    for history_slice in slices:
+        assert history_slice.cursor <= covered_lo or history_slice.lo > covered_hi
+    assert sum(s.cursor - s.lo for s in slices) == (cursor - 1 - target.id + 1) - (covered_hi - covered_lo + 1)
+
+def test_content_filters_ignore_the_index(index):
+    target = channel()
+    index.add_coverage(target.id, snowflake(20), snowflake(10))
+    cursor = snowflake(1)
+    _, slices = plan(target, main.MessageFilter({1: 'alice'}, pattern='spam'), cursor)
+    assert_contiguous(slices, target.id, cursor - 1)
+
+def test_empty_bounds_plan_nothing(index):
+    target = channel()
+    after, cursor = snowflake(5), snowflake(10)
+    assert plan(target, main.MessageFilter({1: 'alice'}, after=after), cursor)[1] == []
+    assert plan(target, main.MessageFilter({1: 'alice'}, after=after, pattern='spam'), cursor)[1] == []
+
+def test_small_ranges_are_not_split_below_the_minimum(index):
+    target = channel(days_old=0.01, last_message_days_ago=0)
+    deleter, slices = plan(target, main.MessageFilter({1: 'alice'}))
+    assert len(slices) == 1
+    assert_contiguous(slices, target.id, deleter.last_message_id - 1)
@@ -0,0 +1,115 @@
+import asyncio
+import sqlite3
+from datetime import timedelta
+from types import SimpleNamespace
+
+import discord
+import pytest
+
+import main
+
+home = SimpleNamespace(id=1, name='guild')
+
+# The schema as it shipped before MIGRATIONS, at user_version 0
+BASE_SCHEMA = '''
+    CREATE TABLE jobs (
+        id INTEGER PRIMARY KEY,
+        guild_id INTEGER NOT NULL,
+        channel_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        cursor INTEGER,
+        scanned INTEGER NOT NULL DEFAULT 0,
+        deleted INTEGER NOT NULL DEFAULT 0,
+        status TEXT NOT NULL DEFAULT 'running',
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    );
+    CREATE TABLE pending (
+        job_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        PRIMARY KEY (job_id, message_id)
+    );
+'''
+
+def snowflake(days_ago):
+    return discord.utils.time_snowflake(discord.utils.utcnow() - timedelta(days=days_ago))
+
+@pytest.mark.parametrize('version', range(len(main.JobStore.MIGRATIONS)))
+def test_migrates_an_older_database(tmp_path, version):
+    path = str(tmp_path / 'old.db')
+    db = sqlite3.connect(path)
+    db.executescript(BASE_SCHEMA)
+    for script in main.JobStore.MIGRATIONS[:version]:
+        db.executescript(script)
+    db.execute(f'PRAGMA user_version = {version}')
+    db.execute("INSERT INTO jobs (guild_id, channel_id, user_id, cursor, created_at, updated_at)"
+               " VALUES (1, 10, 100, 12345, 'then', 'then')")
+    db.commit()
+    db.close()
+
+    store = main.JobStore(path)
+    assert store.db.execute('PRAGMA user_version').fetchone()[0] == len(main.JobStore.MIGRATIONS)
+    job = store.get_job(1)
+    assert (job['cursor'], job['scope'], job['parent_id'], job['sliced'], job['priority']) == (12345, 'channel', None, 0, 0)
+    # A job from before filters were stored targets just its user
+    assert main.MessageFilter.from_job(job).user_ids == {100}
+    assert store.job_slices(1) == []
+    store.db.close()
+
+    # Opening it again leaves it as it is
+    assert main.JobStore(path).db.execute('PRAGMA user_version').fetchone()[0] == len(main.JobStore.MIGRATIONS)
+
+class FakeChannel:
+    def __init__(self):
+        self.id = snowflake(30)
+        self.name = 'channel'
+        self.guild = home
+        self.last_message_id = snowflake(0)
+        self.bulk = []
+        self.singles = []
+
+    def get_partial_message(self, message_id):
+        async def delete():
+            self.singles.append(message_id)
+        return SimpleNamespace(id=message_id, channel=self, delete=delete,
+                               created_at=discord.utils.snowflake_time(message_id))
+
+    async def delete_messages(self, messages):
+        self.bulk += [message.id for message in messages]
+
+def test_resumed_job_deletes_pending_messages_and_continues_its_slices(store, index, monkeypatch):
+    monkeypatch.setattr(main, 'pacer', main.RateLimitPacer())
+    monkeypatch.setattr(main, 'BULK_LINGER', 0.01)
+    channel = FakeChannel()
+    message_filter = main.MessageFilter({1: 'alice'})
+
+    # A run that was interrupted with messages queued and two slices half scanned
+    job = store.create_job(channel, message_filter)
+    top = snowflake(0)
+    slices = [main.HistorySlice(snowflake(10), snowflake(5)), main.HistorySlice(snowflake(25), snowflake(20))]
+    store.plan_slices(job['id'], top, slices)
+    recent = [snowflake(1) + n for n in range(3)]
+    old = [snowflake(20) + n for n in range(2)]
+    for message_id in recent + old:
+        store.add_pending(job['id'], message_id)
+    store.checkpoint(job['id'], top, 500, 7)
+
+    reads = []
+
+    async def read(channel, lo, hi):
+        reads.append((lo, hi))
+        return
+        yield
+
+    monkeypatch.setattr(index, 'read', read)
+    deleter = main.MessageDeleter()
+    asyncio.run(deleter.delete_messages(channel, message_filter, job=store.get_job(job['id'])))
+
+    # Only the rest of the stored slices is read, the history is not planned again
+    assert sorted(reads) == sorted((s.lo, s.cursor - 1) for s in slices)
+    assert sorted(channel.bulk) == recent
+    assert sorted(channel.singles) == old
+    job = store.get_job(job['id'])
+    assert (job['status'], job['deleted'], job['scanned']) == ('done', 12, 500)
+    assert store.pending_messages(job['id']) == []
+    assert store.job_slices(job['id']) == []